@@ -0,0 +1,214 @@
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+import cache
+import filters
+import instrument
+from convolution import MODES, parse_kernel
+from parallel import process_parallel
+from registry import FILTERS, PARAMETERS, apply_chain, default_value
+from tiling import process_tiled
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".gif", ".webp", ".npy")
+
+def parse_step(text):
+    name, _, value = text.partition("=")
+    name = name.strip()
+    if name not in FILTERS:
+        raise argparse.ArgumentTypeError(f"unknown filter {name!r}; choose from: {', '.join(FILTERS)}")
+    if name == "Convolution":
+        # Convolution=[MODE:]ROWS, e.g. Convolution=constant:1,2,1;2,4,2;1,2,1
+        mode, _, rows = value.rpartition(":")
+        if mode and mode not in MODES:
+            raise argparse.ArgumentTypeError(f"unknown padding mode {mode!r}; choose from: {', '.join(MODES)}")
+        try:
+            return name, (parse_kernel(rows), mode or "reflect")
+        except ValueError as error:
+            raise argparse.ArgumentTypeError(f"invalid kernel for {name!r}: {error}")
+    if not value:
+        return name, default_value(name)
+    try:
+        return name, float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid value {value!r} for filter {name!r}")
+
+def collect_inputs(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+        else:
+            matches = sorted(glob.glob(pattern))
+        paths.extend(path for path in matches
+                     if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS))
+    # A file matched twice, under any spelling, is listed once.
+    unique = {}
+    for path in paths:
+        unique.setdefault(os.path.realpath(path), path)
+    return list(unique.values())
+
+def output_path(input_path, output_dir, extension):
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    return os.path.join(output_dir, stem + extension)
+
+def output_collisions(inputs, output_dir, extension):
+    # Outputs are named after the input's file name alone, so a/x.jpg and
+    # b/x.jpg, or x.jpg and x.png, would be written to the same file.
+    # Returns each such destination with the inputs that map to it.
+    sources = {}
+    for input_path in inputs:
+        destination = os.path.normcase(os.path.abspath(output_path(input_path, output_dir, extension)))
+        sources.setdefault(destination, []).append(input_path)
+    return {destination: paths for destination, paths in sources.items() if len(paths) > 1}
+
+def load_input(input_path):
+    # .npy inputs are memory-mapped so tiled runs never read them whole.
+    if input_path.lower().endswith(".npy"):
+        return np.load(input_path, mmap_mode="r")
+    image = Image.open(input_path)
+    if image.mode not in ("L", "RGB"):
+        image = image.convert("RGB")
+    return image
+
+def _write_atomically(destination, write):
+    # Written under a temporary name next to the destination and renamed, so
+    # an interrupted run never leaves a partial file for --resume to skip.
+    # The temporary name keeps the extension, which selects the format.
+    root, extension = os.path.splitext(destination)
+    temporary = f"{root}.{os.getpid()}.tmp{extension}"
+    try:
+        write(temporary)
+        os.replace(temporary, destination)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+def process_file(input_path, destination, steps, tile_memory=None, threads=1):
+    start = time.perf_counter()
+    with instrument.stage("file", path=input_path):
+        with instrument.stage("load"):
+            source = load_input(input_path)
+        if isinstance(source, np.ndarray):
+            pixels = source.shape[0] * source.shape[1]
+        else:
+            pixels = source.width * source.height
+
+        if tile_memory:
+            if destination.lower().endswith(".npy"):
+                _write_atomically(destination, lambda temporary: process_tiled(
+                    source, steps, output=temporary, memory_budget=tile_memory))
+            else:
+                result = Image.fromarray(process_tiled(source, steps, memory_budget=tile_memory))
+                with instrument.stage("save"):
+                    _write_atomically(destination, result.save)
+        else:
+            # The chain runs on a context, so PIL is only used to decode and
+            # encode; .npy files never go through it.
+            source = filters.ImageContext(np.asarray(source) if isinstance(source, np.ndarray) else source)
+            if threads > 1:
+                result = filters.ImageContext(process_parallel(source, steps, workers=threads))
+            elif cache.RESULT_CACHE is not None:
+                result = cache.RESULT_CACHE.apply_chain(source, steps)
+            else:
+                result = apply_chain(source, steps)
+            with instrument.stage("save"):
+                if destination.lower().endswith(".npy"):
+                    _write_atomically(destination, lambda temporary: np.save(temporary, result.array))
+                else:
+                    _write_atomically(destination, result.image.save)
+    return input_path, time.perf_counter() - start, pixels
+
+def init_worker(cache_memory, compact, trace):
+    # With a cache, each worker process keeps its own, and inputs with the
+    # same pixels are not recomputed within that process. It costs a hash of
+    # every input, which is wasted when all the inputs differ, so it is off
+    # unless asked for.
+    cache.RESULT_CACHE = cache.ResultCache(max_bytes=cache_memory) if cache_memory else None
+    filters.COMPACT = compact
+    if trace:
+        instrument.enable(path=trace)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply filters to images without the GUI.")
+    parser.add_argument("inputs", nargs="+", help="image files, directories or glob patterns")
+    parser.add_argument("-f", "--filter", dest="steps", action="append", type=parse_step, required=True,
+                        metavar="NAME[=VALUE]",
+                        help="filter to apply, repeat for a chain (e.g. -f Gaussian=2 -f Sobel); "
+                             "the value defaults to the GUI slider default. For large sigmas, "
+                             "-f 'Recursive Gaussian=SIGMA' takes about the same time at any sigma")
+    parser.add_argument("-o", "--output", required=True, help="output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--format", default="png", help="output file extension (default: png)")
+    parser.add_argument("--resume", action="store_true", help="skip inputs whose output already exists")
+    parser.add_argument("--tile-memory", type=float, metavar="MB",
+                        help="process each image in tiles using about this much working memory; "
+                             "with --format npy the output is written to a memory-mapped file")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="split each image into strips processed on this many threads; "
+                             "useful with few, large images (default: 1)")
+    parser.add_argument("--cache-memory", type=float, default=0, metavar="MB",
+                        help="cache results per worker process in up to this much memory, for input sets "
+                             "with repeated images (default: no cache)")
+    parser.add_argument("--compact", action="store_true",
+                        help="run floating-point filters in float32; output may differ by one level")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="append per-stage timings for each file to PATH as JSON lines")
+    args = parser.parse_args(argv)
+
+    inputs = collect_inputs(args.inputs)
+    if not inputs:
+        parser.error("no input images found")
+
+    extension = "." + args.format.lstrip(".")
+    collisions = output_collisions(inputs, args.output, extension)
+    if collisions:
+        parser.error("several inputs would be written to the same output file:\n" + "\n".join(
+            f"  {destination}: {', '.join(paths)}" for destination, paths in collisions.items()))
+    os.makedirs(args.output, exist_ok=True)
+    jobs = []
+    for input_path in inputs:
+        destination = output_path(input_path, args.output, extension)
+        if args.resume and os.path.exists(destination):
+            print(f"skip  {input_path}")
+            continue
+        jobs.append((input_path, destination))
+
+    chain = " -> ".join(name if PARAMETERS[name] is None else f"{name}={value:g}" for name, value in args.steps)
+    print(f"{len(jobs)} image(s), {len(inputs) - len(jobs)} skipped, {args.jobs} worker(s): {chain}")
+
+    failures = 0
+    total_pixels = 0
+    tile_memory = args.tile_memory * 2**20 if args.tile_memory else None
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker,
+                             initargs=(args.cache_memory * 2**20, args.compact, args.trace)) as executor:
+        futures = {executor.submit(process_file, input_path, destination, args.steps, tile_memory, args.threads):
+                   input_path
+                   for input_path, destination in jobs}
+        for future in as_completed(futures):
+            try:
+                input_path, seconds, pixels = future.result()
+            except Exception as error:
+                failures += 1
+                print(f"error {futures[future]}: {error}", file=sys.stderr)
+                continue
+            total_pixels += pixels
+            print(f"done  {input_path}  {seconds:.3f} s  {pixels / seconds / 1e6:.2f} MP/s")
+    elapsed = time.perf_counter() - start
+
+    done = len(jobs) - failures
+    if elapsed > 0 and done:
+        print(f"{done} image(s), {total_pixels / 1e6:.1f} MP in {elapsed:.2f} s: "
+              f"{done / elapsed:.2f} images/s, {total_pixels / elapsed / 1e6:.2f} MP/s")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,410 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import PIL
+from PIL import Image
+
+import filters
+from batch import parse_step
+from convolution import choose_engine, convolve, separate
+from loader import cache_path, decode_preview, load_preview
+from parallel import default_workers, process_parallel
+from registry import FILTERS, PARAMETERS, apply_filter
+
+SIZES = {
+    "256": (256, 256),
+    "512": (512, 512),
+    "1024": (1024, 1024),
+    "1080p": (1920, 1080),
+    "4k": (3840, 2160),
+}
+QUICK_SIZES = ("256", "512")
+SAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample_images")
+STARTUP_TARGET = 0.3
+PREVIEW_SIZE = (320, 320)
+# Convolution takes a kernel rather than a slider value; the kernels
+# command times it.
+SWEPT_FILTERS = [name for name in FILTERS if name != "Convolution"]
+# Neighbourhood filters at sizes where the work per pixel is realistic.
+SCALING_STEPS = [("Averaging", 15), ("Median", 5), ("Gaussian", 3), ("Kuwahara", 5), ("Sobel", 0)]
+
+# Run in a fresh interpreter for each measurement. Prints the wall-clock
+# time once the window has been painted and again once the filters and
+# workers have loaded.
+STARTUP_SCRIPT = """
+import sys, time
+sys.path.insert(0, sys.argv[1])
+import main
+app = main.App()
+app.root.update()
+print(time.time(), flush=True)
+app.load_modules()
+print(time.time(), flush=True)
+app.root.destroy()
+"""
+
+def synthetic_image(width, height, mode, seed=0):
+    # Smooth gradients with texture and noise, so that edge, median and
+    # threshold filters all have something to do.
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width] / max(width, height)
+    planes = [128 + 100 * np.sin(2 * np.pi * (x * (3 + c) + y * (2 + c))) for c in range(3)]
+    image_array = np.stack(planes, axis=-1) + rng.normal(0, 20, (height, width, 3))
+    image = Image.fromarray(np.clip(image_array, 0, 255).astype(np.uint8))
+    return image if mode == "RGB" else image.convert(mode)
+
+def test_images(sizes, modes, samples=True):
+    images = []
+    for size in sizes:
+        width, height = SIZES[size]
+        for mode in modes:
+            images.append((f"synthetic-{size}", mode, synthetic_image(width, height, mode)))
+    if samples:
+        for path in sorted(glob.glob(os.path.join(SAMPLE_DIR, "*"))):
+            source = Image.open(path)
+            for mode in modes:
+                images.append((os.path.basename(path), mode, source.convert(mode)))
+    return images
+
+def sweep(name):
+    # The slider minimum, default and maximum from the GUI.
+    if PARAMETERS[name] is None:
+        return [0]
+    return sorted(set(PARAMETERS[name]))
+
+def output_hash(image):
+    return hashlib.blake2b(np.ascontiguousarray(np.array(image)).tobytes(), digest_size=16).hexdigest()
+
+def best_time(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+def measure(function, repeat):
+    # Best wall time of repeat runs, then one more run under tracemalloc for
+    # the peak, so tracing does not slow the timed runs.
+    result, best = best_time(function, repeat)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+def run_filters(images, names, repeat, log=print):
+    results = []
+    for image_name, mode, image in images:
+        for name in names:
+            for value in sweep(name):
+                output, seconds, peak = measure(lambda: apply_filter(image, name, value), repeat)
+                pixels = image.width * image.height
+                results.append({
+                    "filter": name, "value": value, "image": image_name, "mode": mode,
+                    "width": image.width, "height": image.height,
+                    "seconds": seconds, "pixels_per_second": pixels / seconds if seconds else None,
+                    "peak_bytes": peak, "output_hash": output_hash(output),
+                })
+                log(f"{name:13s} {value:>6g}  {image_name:18s} {mode:3s} {image.width}x{image.height}  "
+                    f"{seconds * 1000:9.1f} ms  {pixels / seconds / 1e6 if seconds else 0:8.2f} MP/s  "
+                    f"{peak / 2**20:8.1f} MB")
+    return results
+
+def environment():
+    return {
+        "python": platform.python_version(), "numpy": np.__version__, "pillow": PIL.__version__,
+        "machine": platform.machine(), "processor": platform.processor(), "cpus": os.cpu_count(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+
+def run(args):
+    filters.COMPACT = args.compact
+    config = {"sizes": args.sizes, "modes": args.modes, "filters": args.filters,
+              "samples": args.samples, "repeat": args.repeat, "compact": args.compact}
+    images = test_images(args.sizes, args.modes, args.samples)
+    results = run_filters(images, args.filters, args.repeat)
+    return {"environment": environment(), "config": config, "results": results}
+
+def case_key(result):
+    return (result["filter"], result["value"], result["image"], result["mode"])
+
+def compare_results(baseline, current, tolerance, min_seconds):
+    # A case regresses when it is slower than the baseline by more than the
+    # tolerance and by at least min_seconds; any change of output is flagged.
+    reference = {case_key(result): result for result in baseline["results"]}
+    regressions, changed, faster = [], [], 0
+    for result in current["results"]:
+        old = reference.get(case_key(result))
+        if old is None:
+            continue
+        if result["output_hash"] != old["output_hash"]:
+            changed.append(result)
+        ratio = result["seconds"] / old["seconds"] if old["seconds"] else 1
+        if ratio > 1 + tolerance and result["seconds"] - old["seconds"] >= min_seconds:
+            regressions.append((result, ratio))
+        elif ratio < 1 / (1 + tolerance):
+            faster += 1
+    return regressions, changed, faster
+
+def compare(args):
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    if args.current:
+        with open(args.current) as file:
+            current = json.load(file)
+    else:
+        # Rerun the cases the baseline measured; --compact still comes from
+        # the command line, since it picks the implementation under test.
+        for key in ("sizes", "modes", "filters", "samples", "repeat"):
+            setattr(args, key, baseline["config"][key])
+        current = run(args)
+
+    regressions, changed, faster = compare_results(baseline, current, args.tolerance, args.min_seconds)
+    for result, ratio in regressions:
+        print(f"SLOWER   {' '.join(map(str, case_key(result)))}: {ratio:.2f}x the baseline time")
+    for result in changed:
+        print(f"CHANGED  {' '.join(map(str, case_key(result)))}: output differs from the baseline")
+    print(f"{len(current['results'])} case(s): {len(regressions)} slower, {faster} faster, "
+          f"{len(changed)} with changed output")
+    return current, 1 if regressions or changed else 0
+
+def worker_counts(maximum):
+    counts = [1]
+    while counts[-1] * 2 <= maximum:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != maximum:
+        counts.append(maximum)
+    return counts
+
+def scaling(args):
+    # Speedup is the serial time over the parallel time and efficiency the
+    # speedup per worker. Every parallel output must equal the serial one.
+    filters.COMPACT = args.compact
+    width, height = SIZES[args.size]
+    image = synthetic_image(width, height, args.mode)
+    results, status = [], 0
+    for name, value in args.steps:
+        serial, serial_seconds = best_time(lambda: np.asarray(apply_filter(image, name, value)), args.repeat)
+        for workers in worker_counts(args.workers):
+            output, seconds = best_time(lambda: process_parallel(image, [(name, value)], workers=workers,
+                                                                 processes=args.processes), args.repeat)
+            speedup = serial_seconds / seconds
+            identical = np.array_equal(output, serial)
+            status = status or not identical
+            results.append({"filter": name, "value": value, "workers": workers, "seconds": seconds,
+                            "serial_seconds": serial_seconds, "speedup": speedup,
+                            "efficiency": speedup / workers, "identical": identical})
+            print(f"{name:13s} {value:>6g}  {workers:3d} worker(s)  {seconds * 1000:9.1f} ms  "
+                  f"speedup {speedup:5.2f}  efficiency {speedup / workers:4.0%}"
+                  + ("" if identical else "  OUTPUT DIFFERS"))
+    config = {"size": args.size, "mode": args.mode, "processes": args.processes, "compact": args.compact,
+              "repeat": args.repeat}
+    return {"environment": environment(), "config": config, "results": results}, int(status)
+
+def test_kernel(kind, size, seed=0):
+    # A separable blur, a sparse diagonal motion blur and a dense kernel of
+    # full rank, each summing to one.
+    if kind == "gaussian":
+        weights = np.exp(-0.5 * (np.linspace(-2, 2, size) ** 2))
+        kernel = np.outer(weights, weights)
+    elif kind == "motion":
+        kernel = np.eye(size)
+    else:
+        kernel = np.random.default_rng(seed).random((size, size))
+    return kernel / kernel.sum()
+
+def kernels(args):
+    # Times every engine that applies to each kernel and marks the fastest
+    # and the one the cost model picks. Outputs of different engines may
+    # only differ at half-level ties, so by one level.
+    filters.COMPACT = args.compact
+    width, height = SIZES[args.size]
+    image = synthetic_image(width, height, args.mode)
+    results, status = [], 0
+    for kind in args.kinds:
+        for size in args.kernel_sizes:
+            kernel = test_kernel(kind, size)
+            separable = separate(kernel)
+            engines = ["direct", "fft"] + (["separable"] if separable is not None else [])
+            times, outputs = {}, {}
+            for engine in engines:
+                outputs[engine], times[engine] = best_time(
+                    lambda: np.asarray(convolve(image, kernel, engine=engine), dtype=int), args.repeat)
+            fastest, chosen = min(times, key=times.get), choose_engine(kernel, separable, (height, width))
+            spread = max(np.abs(output - outputs["direct"]).max() for output in outputs.values())
+            status = status or spread > 1
+            results.append({"kind": kind, "size": size, "seconds": times, "fastest": fastest,
+                            "chosen": chosen, "max_difference": int(spread)})
+            print(f"{kind:8s} {size:3d}x{size:<3d}  " + "  ".join(
+                f"{engine} {times[engine] * 1000:8.1f} ms" + ("*" if engine == fastest else " ")
+                for engine in engines) + f"   auto: {chosen}"
+                + ("" if times[chosen] <= 1.25 * times[fastest] else " (slow)"))
+    config = {"size": args.size, "mode": args.mode, "compact": args.compact, "repeat": args.repeat}
+    return {"environment": environment(), "config": config, "results": results}, int(status)
+
+def startup_times():
+    start = time.time()
+    completed = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT, os.path.dirname(os.path.abspath(__file__))],
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        lines = completed.stderr.strip().splitlines()
+        raise RuntimeError(lines[-1] if lines else f"exit status {completed.returncode}")
+    painted, ready = map(float, completed.stdout.split())
+    return painted - start, ready - start
+
+def startup(args):
+    # The first run is the coldest the operating system's file cache allows;
+    # the median of all runs is checked against the target.
+    runs = []
+    for _ in range(args.repeat):
+        try:
+            runs.append(startup_times())
+        except RuntimeError as error:
+            print(f"could not start the GUI: {error}")
+            return None, 1
+    painted = statistics.median(run[0] for run in runs)
+    ready = statistics.median(run[1] for run in runs)
+    print(f"first paint {painted * 1000:.0f} ms (first run {runs[0][0] * 1000:.0f} ms, "
+          f"target {args.target * 1000:.0f} ms), filters loaded {ready * 1000:.0f} ms")
+    results = {"environment": environment(), "target": args.target, "first_paint": painted,
+               "ready": ready, "runs": runs}
+    return results, 0 if painted <= args.target else 1
+
+def full_decode(path, size):
+    # What the viewer did before draft decoding: decode everything, then
+    # resample the whole image.
+    with Image.open(path) as image:
+        image.load()
+        return image.resize(size, Image.LANCZOS)
+
+def decode(args):
+    # Preview load times for each file: a full decode and resize, a reduced
+    # decode, and a load from the preview cache, which is filled by the
+    # first cached run. The difference is the largest level difference
+    # between the full and the reduced preview.
+    size = tuple(args.size)
+    paths = [path for pattern in args.images for path in sorted(glob.glob(pattern))]
+    results = []
+    for path in paths:
+        full, full_seconds = best_time(lambda: full_decode(path, size), args.repeat)
+        reduced, reduced_seconds = best_time(lambda: decode_preview(path, size)[0], args.repeat)
+        cached = cache_path(path, size)
+        if os.path.exists(cached):
+            os.remove(cached)
+        load_preview(path, size)
+        _, cached_seconds = best_time(lambda: load_preview(path, size), args.repeat)
+        difference = int(np.abs(np.asarray(full, dtype=int) - np.asarray(reduced, dtype=int)).max())
+        with Image.open(path) as image:
+            width, height = image.size
+        results.append({"path": path, "width": width, "height": height, "full_seconds": full_seconds,
+                        "reduced_seconds": reduced_seconds, "cached_seconds": cached_seconds,
+                        "max_difference": difference})
+        print(f"{os.path.basename(path):24s} {width}x{height}  full {full_seconds * 1000:8.1f} ms  "
+              f"reduced {reduced_seconds * 1000:7.1f} ms  cached {cached_seconds * 1000:6.1f} ms  "
+              f"max difference {difference}")
+    config = {"size": size, "repeat": args.repeat}
+    return {"environment": environment(), "config": config, "results": results}, 0 if paths else 1
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every filter and check its output against a baseline.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_run_options(subparser):
+        subparser.add_argument("--sizes", nargs="+", choices=list(SIZES), default=list(SIZES),
+                               help="synthetic image sizes (default: all)")
+        subparser.add_argument("--quick", action="store_const", dest="sizes", const=list(QUICK_SIZES),
+                               help=f"only the {' and '.join(QUICK_SIZES)} synthetic images")
+        subparser.add_argument("--modes", nargs="+", choices=("L", "RGB"), default=["L", "RGB"])
+        subparser.add_argument("--filters", nargs="+", choices=SWEPT_FILTERS, default=SWEPT_FILTERS,
+                               metavar="NAME", help="filters to run (default: all)")
+        subparser.add_argument("--no-samples", dest="samples", action="store_false",
+                               help="skip the images in sample_images/")
+        subparser.add_argument("--repeat", type=int, default=3, help="timed runs per case; the best is kept")
+        subparser.add_argument("--compact", action="store_true", help="run with filters.COMPACT set")
+        subparser.add_argument("-o", "--output", help="write the results to this JSON file")
+
+    run_parser = subparsers.add_parser("run", help="measure and record results")
+    add_run_options(run_parser)
+
+    compare_parser = subparsers.add_parser("compare", help="flag regressions against a baseline results file")
+    compare_parser.add_argument("baseline", help="results file from an earlier run")
+    compare_parser.add_argument("current", nargs="?", help="results file to check; by default the "
+                                "baseline's cases are measured again")
+    compare_parser.add_argument("--tolerance", type=float, default=0.25,
+                                help="allowed slowdown as a fraction (default: 0.25)")
+    compare_parser.add_argument("--min-seconds", type=float, default=0.005,
+                                help="ignore slowdowns smaller than this (default: 0.005)")
+    add_run_options(compare_parser)
+
+    scaling_parser = subparsers.add_parser("scaling", help="time strip-parallel execution from 1 to N workers")
+    scaling_parser.add_argument("-f", "--filter", dest="steps", action="append", type=parse_step,
+                                metavar="NAME[=VALUE]", help="filter to time, repeatable (default: "
+                                + ", ".join(f"{name}={value:g}" for name, value in SCALING_STEPS) + ")")
+    scaling_parser.add_argument("--size", choices=list(SIZES), default="1080p")
+    scaling_parser.add_argument("--mode", choices=("L", "RGB"), default="RGB")
+    scaling_parser.add_argument("--workers", type=int, default=default_workers(),
+                                help="largest worker count; powers of two up to it are timed too")
+    scaling_parser.add_argument("--processes", action="store_true",
+                                help="use a process pool with shared memory instead of threads")
+    scaling_parser.add_argument("--repeat", type=int, default=3, help="timed runs per case; the best is kept")
+    scaling_parser.add_argument("--compact", action="store_true", help="run with filters.COMPACT set")
+    scaling_parser.add_argument("-o", "--output", help="write the results to this JSON file")
+
+    kernels_parser = subparsers.add_parser("kernels", help="time the convolution engines against each other")
+    kernels_parser.add_argument("--kinds", nargs="+", choices=("gaussian", "motion", "dense"),
+                                default=["gaussian", "motion", "dense"])
+    kernels_parser.add_argument("--kernel-sizes", nargs="+", type=int, default=[3, 5, 9, 15, 25, 41, 64])
+    kernels_parser.add_argument("--size", choices=list(SIZES), default="1024")
+    kernels_parser.add_argument("--mode", choices=("L", "RGB"), default="RGB")
+    kernels_parser.add_argument("--repeat", type=int, default=3, help="timed runs per case; the best is kept")
+    kernels_parser.add_argument("--compact", action="store_true", help="run with filters.COMPACT set")
+    kernels_parser.add_argument("-o", "--output", help="write the results to this JSON file")
+
+    startup_parser = subparsers.add_parser("startup", help="time the GUI from process start to first paint")
+    startup_parser.add_argument("--repeat", type=int, default=5, help="fresh processes to time (default: 5)")
+    startup_parser.add_argument("--target", type=float, default=STARTUP_TARGET,
+                                help=f"fail if the median first paint takes longer, in seconds "
+                                     f"(default: {STARTUP_TARGET})")
+    startup_parser.add_argument("-o", "--output", help="write the results to this JSON file")
+
+    decode_parser = subparsers.add_parser("decode", help="time preview loading with and without reduced decoding")
+    decode_parser.add_argument("images", nargs="+", help="image files or glob patterns")
+    decode_parser.add_argument("--size", nargs=2, type=int, default=PREVIEW_SIZE, metavar=("WIDTH", "HEIGHT"),
+                               help="preview size (default: %(default)s)")
+    decode_parser.add_argument("--repeat", type=int, default=3, help="timed runs per case; the best is kept")
+    decode_parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        results, status = run(args), 0
+    elif args.command == "scaling":
+        args.steps = args.steps or SCALING_STEPS
+        results, status = scaling(args)
+    elif args.command == "kernels":
+        results, status = kernels(args)
+    elif args.command == "startup":
+        results, status = startup(args)
+    elif args.command == "decode":
+        results, status = decode(args)
+    else:
+        results, status = compare(args)
+
+    if args.output and results is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=1)
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
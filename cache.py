@@ -0,0 +1,128 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from filters import ImageContext
+from registry import apply_filter, normalize_value
+
+def content_key(image):
+    if isinstance(image, ImageContext):
+        # Hashed from the array without making a PIL image, keyed like the
+        # PIL image it stands for, whose bytes are the same.
+        return image.memo('content_key', lambda: (
+            hashlib.blake2b(image.array, digest_size=16).hexdigest(), (image.mode, image.size)))
+    if isinstance(image, np.ndarray):
+        data, layout = np.ascontiguousarray(image), (str(image.dtype), image.shape)
+    else:
+        data, layout = image.tobytes(), (image.mode, image.size)
+    return hashlib.blake2b(data, digest_size=16).hexdigest(), layout
+
+def chain_keys(image, steps):
+    # One key per prefix of the chain, so a chain that shares its first steps
+    # with an earlier one can pick up from the deepest cached result.
+    base = content_key(image)
+    keys = []
+    prefix = ()
+    for name, value in steps:
+        prefix += ((name, normalize_value(name, value)),)
+        keys.append((base, prefix))
+    return keys
+
+def _bare(image):
+    # A context holding only the array and its key. Padded buffers, tables
+    # and the grayscale version are made on the copy a caller works with, so
+    # they never accumulate, uncounted, on a stored entry.
+    if not isinstance(image, ImageContext):
+        return image
+    bare = ImageContext(image.array, image.original_size)
+    if 'content_key' in image.memos:
+        bare.memos['content_key'] = image.memos['content_key']
+    return bare
+
+def _result_bytes(image):
+    if isinstance(image, (np.ndarray, ImageContext)):
+        return np.asarray(image).nbytes
+    return image.width * image.height * len(image.getbands())
+
+class ResultCache():
+    # LRU cache of filter results, bounded by entry count and by the bytes of
+    # the stored images. Lookups may come from worker threads. Stored images
+    # are shared between callers and must not be modified in place.
+    def __init__(self, max_entries=64, max_bytes=256 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return _bare(self.entries[key])
+
+    def put(self, key, image):
+        image = _bare(image)
+        size = _result_bytes(image)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= _result_bytes(self.entries.pop(key))
+            if size > self.max_bytes:
+                return
+            self.entries[key] = image
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self.bytes -= _result_bytes(self.entries.popitem(last=False)[1])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self.entries), "bytes": self.bytes}
+
+    def longest_prefix(self, image, steps):
+        # Returns how many steps are already done, the image to continue
+        # from and the keys for every prefix.
+        keys = chain_keys(image, steps)
+        with self.lock:
+            for count in range(len(keys), 0, -1):
+                if keys[count - 1] in self.entries:
+                    self.hits += 1
+                    self.entries.move_to_end(keys[count - 1])
+                    return count, _bare(self.entries[keys[count - 1]]), keys
+            self.misses += 1
+        return 0, image, keys
+
+    def apply_chain(self, image, steps):
+        # Runs of pointwise steps are applied as one lookup table, as
+        # registry.apply_chain does, so only the result at the end of a run
+        # is stored.
+        from pointwise import apply_pointwise, is_pointwise
+
+        count, image, keys = self.longest_prefix(image, steps)
+        while count < len(steps):
+            end = count
+            while end < len(steps) and is_pointwise(steps[end][0]):
+                end += 1
+            if end > count:
+                image = apply_pointwise(image, steps[count:end])
+            else:
+                name, value = steps[count]
+                image = apply_filter(image, name, value)
+                end = count + 1
+            self.put(keys[end - 1], image)
+            count = end
+        return image
+
+RESULT_CACHE = ResultCache()
@@ -0,0 +1,210 @@
+from fractions import Fraction
+
+import numpy as np
+
+from filters import image_context, image_filter, _accumulate, _bands, _float_dtype, _output, _separable_correlate, _store, _sum_dtype
+from instrument import stage
+
+ENGINES = ("direct", "separable", "fft")
+MODES = ("reflect", "constant")
+MAX_KERNEL_SIZE = 64
+
+# A kernel counts as separable when its second singular value is this small
+# relative to the first.
+SEPARABLE_TOLERANCE = 1e-9
+
+# Cost model in units of one multiply-add per output pixel of the direct
+# engine: a butterfly of the FFT engine, per element of its transform, and
+# the fixed cost of its blocks, splitting and overlap-adding, per output
+# pixel. Fitted to 'benchmark.py kernels'.
+FFT_COST = 1.2
+FFT_OVERHEAD = 20
+
+def parse_kernel(text):
+    # Rows are separated by ';' or new lines, values by spaces or commas.
+    # Values may be fractions such as 1/16.
+    rows = [row.replace(",", " ").split() for row in text.replace(";", "\n").splitlines()]
+    rows = [row for row in rows if row]
+    if not rows:
+        raise ValueError("the kernel is empty")
+    if any(len(row) != len(rows[0]) for row in rows):
+        raise ValueError("every kernel row needs the same number of values")
+    if len(rows) > MAX_KERNEL_SIZE or len(rows[0]) > MAX_KERNEL_SIZE:
+        raise ValueError(f"kernels are limited to {MAX_KERNEL_SIZE}x{MAX_KERNEL_SIZE}")
+    try:
+        return tuple(tuple(float(Fraction(value)) for value in row) for row in rows)
+    except (ValueError, ZeroDivisionError):
+        raise ValueError(f"invalid kernel value in {text!r}")
+
+def separate(kernel):
+    # Column and row weights whose outer product is the kernel, or None when
+    # its rank is above one.
+    u, s, vt = np.linalg.svd(kernel)
+    if s[0] == 0 or (len(s) > 1 and s[1] > SEPARABLE_TOLERANCE * s[0]):
+        return None
+    scale = np.sqrt(s[0])
+    return u[:, 0] * scale, vt[0] * scale
+
+def _good_size(n):
+    # Smallest length >= n with no prime factor above 5, which pocketfft
+    # transforms quickly.
+    while True:
+        m = n
+        for p in (2, 3, 5):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+def fft_plan(kernel_shape):
+    # Transform shape, and the block of input each transform covers. Blocks
+    # are at least as large as the kernel, which the column overlap-add in
+    # _fft_correlate relies on.
+    transform = tuple(_good_size(max(64, 4 * k)) for k in kernel_shape)
+    return transform, tuple(t - k + 1 for t, k in zip(transform, kernel_shape))
+
+def engine_costs(kernel, separable=None, shape=None):
+    # With the image shape, the FFT engine is charged for the partial blocks
+    # at the edges of the padded image too, which matters for small images.
+    costs = {"direct": np.count_nonzero(kernel)}
+    if separable is not None:
+        costs["separable"] = np.count_nonzero(separable[0]) + np.count_nonzero(separable[1])
+    transform, block = fft_plan(kernel.shape)
+    area = transform[0] * transform[1]
+    if shape is None:
+        blocks_per_pixel = 1 / (block[0] * block[1])
+    else:
+        blocks = [-(-(n + k - 1) // b) for n, k, b in zip(shape, kernel.shape, block)]
+        blocks_per_pixel = blocks[0] * blocks[1] / (shape[0] * shape[1])
+    costs["fft"] = FFT_COST * area * np.log2(area) * blocks_per_pixel + FFT_OVERHEAD
+    return costs
+
+def choose_engine(kernel, separable=None, shape=None):
+    costs = engine_costs(kernel, separable, shape)
+    return min(costs, key=costs.get)
+
+def fft_working_bytes(kernel_shape, shape):
+    # Rough peak of the bytes the FFT engine allocates on an image of this
+    # shape: the padded image, the float result and, for one row of blocks,
+    # the strip, the accumulator, the pieces and the spectra, of which the
+    # transforms hold up to three at a time.
+    rows, cols = shape[:2]
+    channels = int(np.prod(shape[2:]))
+    radius = max(kernel_shape) // 2
+    transform, (block_rows, block_cols) = fft_plan(kernel_shape)
+    count = -(-(cols + kernel_shape[1] - 1) // block_cols)
+    spectrum = transform[0] * (transform[1] // 2 + 1) * 16
+    per_channel = (rows * cols * 8 + block_rows * count * block_cols * 8
+                   + transform[0] * (count + 1) * block_cols * 8
+                   + count * (3 * spectrum + transform[0] * transform[1] * 8))
+    padded = (rows + 2 * radius) * (cols + 2 * radius)
+    return channels * (per_channel + padded + rows * cols) + 2 * spectrum
+
+def _fft_correlate(padded_image, kernel, shape, dtype):
+    # Overlap-add: each block of the padded image is convolved with the
+    # flipped kernel through one transform, and the overlapping tails of
+    # neighbouring blocks are added. Along the rows this runs over one row
+    # of blocks at a time, keeping only the rows that later blocks still add
+    # to, so memory stays proportional to a row of blocks.
+    rows, cols = shape[0], shape[1]
+    kernel_rows, kernel_cols = kernel.shape
+    transform, (block_rows, block_cols) = fft_plan(kernel.shape)
+    padded_image = padded_image.reshape(padded_image.shape[:2] + (-1,))
+    channels = padded_image.shape[2]
+
+    count = -(-padded_image.shape[1] // block_cols)
+    kernel_spectrum = np.fft.rfft2(kernel[::-1, ::-1].astype(dtype), transform)[None, :, :, None]
+    strip = np.zeros((block_rows, count * block_cols, channels), dtype=dtype)
+    accumulator = np.zeros((transform[0], (count + 1) * block_cols, channels), dtype=dtype)
+    result = np.empty((rows, cols, channels), dtype=dtype)
+
+    for top in range(0, rows + kernel_rows - 1, block_rows):
+        strip[...] = 0
+        source = padded_image[top:top + block_rows]
+        strip[:len(source), :source.shape[1]] = source
+        blocks = strip.reshape(block_rows, count, block_cols, channels).transpose(1, 0, 2, 3)
+        spectra = np.fft.rfft2(blocks, transform, axes=(1, 2))
+        spectra *= kernel_spectrum
+        pieces = np.fft.irfft2(spectra, transform, axes=(1, 2)).astype(dtype, copy=False)
+
+        heads = accumulator[:, :count * block_cols].reshape(transform[0], count, block_cols, channels)
+        heads += pieces[:, :, :block_cols].transpose(1, 0, 2, 3)
+        tails = accumulator[:, block_cols:].reshape(transform[0], count, block_cols, channels)
+        tails[:, :, :kernel_cols - 1] += pieces[:, :, block_cols:].transpose(1, 0, 2, 3)
+
+        # Full-convolution rows top .. top + block_rows are now final; the
+        # valid output starts kernel_rows - 1 rows into the full result.
+        first, last = max(top, kernel_rows - 1), min(top + block_rows, rows + kernel_rows - 1)
+        if first < last:
+            result[first - kernel_rows + 1:last - kernel_rows + 1] = \
+                accumulator[first - top:last - top, kernel_cols - 1:kernel_cols - 1 + cols]
+        accumulator[:transform[0] - block_rows] = accumulator[block_rows:]
+        accumulator[transform[0] - block_rows:] = 0
+
+    return result.reshape(shape)
+
+@image_filter
+def convolve(image, kernel, mode='reflect', engine='auto', out=None):
+    # Applies the kernel as written, like the built-in kernel filters: each
+    # output pixel is the sum of the kernel times the neighbourhood it
+    # covers, centred at ((rows - 1) // 2, (cols - 1) // 2) of the kernel.
+    # Results are rounded to the nearest level, so the engines agree wherever
+    # the exact value is not a half-level tie. Integer kernels on the direct
+    # engine are exact.
+    kernel = np.asarray(kernel, dtype=float)
+    if kernel.ndim != 2 or kernel.size == 0:
+        raise ValueError("the kernel must be a non-empty matrix")
+    if mode not in MODES:
+        raise ValueError(f"unknown padding mode {mode!r}; choose from: {', '.join(MODES)}")
+    if engine not in ENGINES + ("auto",):
+        raise ValueError(f"unknown engine {engine!r}; choose from: auto, {', '.join(ENGINES)}")
+
+    context = image_context(image)
+    rows, cols = context.shape[:2]
+    separable = separate(kernel)
+    if engine == 'auto':
+        engine = choose_engine(kernel, separable, (rows, cols))
+    elif engine == 'separable' and separable is None:
+        raise ValueError("the kernel is not separable")
+
+    kernel_rows, kernel_cols = kernel.shape
+    radius = max(kernel.shape) // 2
+    top, left = radius - (kernel_rows - 1) // 2, radius - (kernel_cols - 1) // 2
+    padded_image = context.padded(radius, mode)[top:top + rows + kernel_rows - 1, left:left + cols + kernel_cols - 1]
+    out = _output(context.shape, out)
+    dtype = _float_dtype()
+
+    if engine == 'fft':
+        with stage(engine):
+            values = _fft_correlate(padded_image, kernel, context.shape, dtype)
+            np.rint(values, out=values)
+        _store(values, out, 0, rows)
+        return out
+
+    integer = engine == 'direct' and np.array_equal(kernel, np.round(kernel))
+    if integer:
+        weights = kernel.astype(np.int64).ravel()
+        dtype = _sum_dtype(np.abs(weights).sum() * 255)
+    for band_top, band_bottom in _bands(rows, cols):
+        band = padded_image[band_top:band_bottom + kernel_rows - 1]
+        shape = (band_bottom - band_top,) + context.shape[1:]
+        with stage(engine):
+            if engine == 'separable':
+                values = _separable_correlate(band, separable[0].astype(dtype), separable[1].astype(dtype),
+                                              shape, dtype)
+            else:
+                windows = (band[a:a+shape[0], b:b+cols] for a in range(kernel_rows) for b in range(kernel_cols))
+                values = _accumulate(windows, weights if integer else kernel.astype(dtype).ravel(), dtype)
+            if values is None:
+                values = np.zeros(shape, dtype=dtype)
+            elif not integer:
+                np.rint(values, out=values)
+        _store(values, out, band_top, band_bottom)
+
+    return out
+
+def convolution(image, value, out=None):
+    # Registry entry: value is a (kernel rows, padding mode) pair.
+    kernel, mode = value
+    return convolve(image, kernel, mode, out=out)
@@ -1,350 +1,720 @@
+import functools
+from collections import OrderedDict
+
 import numpy as np
 from PIL import Image
 
-def grayscale(image, *args):
-    image_array = np.array(image).astype(float)
-
-    if image_array.ndim == 2:
+from instrument import stage, instrumented
+
+# Compact mode runs the floating-point paths (gaussian and kernels with a
+# fractional weight) in float32 instead of float64. Their output can then
+# differ by one level. Integer paths are exact in either mode.
+COMPACT = False
+
+# Filters work through the image in bands of about this many pixels, so
+# their wide temporaries never cover the whole image.
+_BAND_PIXELS = 2**16
+
+class ImageContext():
+    # The working image: a C-contiguous uint8 array of shape (rows, cols) or
+    # (rows, cols, channels), the mode it stands for and the size of the
+    # original it was derived from, plus representations several filters
+    # derive from it: the grayscale version, padded buffers and summed-area
+    # tables. Each is computed on first use and kept. Cached arrays are
+    # read-only. A new image needs a new context.
+    #
+    # Filters given a context return one, so a chain never goes through PIL.
+    # The PIL image is only made when .image is asked for, at display and
+    # save time; Image.fromarray shares the buffer for single-channel and
+    # RGBA images and copies RGB, which PIL stores four bytes to a pixel.
+    MAX_BUFFERS = 8
+
+    def __init__(self, image, original_size=None):
+        self.memos = {}
+        # Padded buffers and tables depend on the kernel size, so only the
+        # most recently used ones are kept.
+        self.buffers = OrderedDict()
+        if isinstance(image, np.ndarray):
+            # A read-only view, so the caller's array stays writable.
+            array = np.ascontiguousarray(_uint8_array(image)).view()
+            self.memos['convert'] = _read_only(array)
+            self._image = None
+        else:
+            self._image = _working_image(image)
+        self.original_size = original_size or self.size
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.array
+        if dtype is not None and np.dtype(dtype) != array.dtype:
+            return array.astype(dtype)
+        return array.copy() if copy else array
+
+    def memo(self, key, compute):
+        if key not in self.memos:
+            with stage(key if isinstance(key, str) else key[0]):
+                self.memos[key] = _read_only(compute())
+        return self.memos[key]
+
+    def buffer(self, key, compute):
+        if key in self.buffers:
+            self.buffers.move_to_end(key)
+        else:
+            with stage(key[0]):
+                self.buffers[key] = _read_only(compute())
+            if len(self.buffers) > self.MAX_BUFFERS:
+                self.buffers.popitem(last=False)
+        return self.buffers[key]
+
+    @property
+    def array(self):
+        return self.memo('convert', lambda: np.array(self._image))
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = Image.fromarray(self.array)
+        return self._image
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def size(self):
+        # (width, height), as PIL gives it.
+        if self._image is not None:
+            return self._image.size
+        return self.array.shape[1], self.array.shape[0]
+
+    @property
+    def mode(self):
+        if self._image is not None:
+            return self._image.mode
+        channels = self.array.shape[2] if self.array.ndim == 3 else 1
+        return {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[channels]
+
+    def grayscale(self):
+        if self.array.ndim == 2:
+            return self
+        return self.memo('grayscale', lambda: ImageContext(_grayscale_array(self.array), self.original_size))
+
+    def padded(self, radius, mode):
+        return self.buffer(('padded', radius, mode), lambda: _pad(self.array, radius, radius, mode))
+
+    def integral(self, radius, mode, squares=False, dtype=np.int64):
+        def compute():
+            padded_image = self.padded(radius, mode)
+            if squares:
+                padded_image = np.square(padded_image, dtype=np.promote_types(dtype, np.int32))
+            return _integral_image(padded_image, dtype)
+        return self.buffer(('integral', radius, mode, squares, np.dtype(dtype)), compute)
+
+def _working_image(image):
+    # The filters take 8-bit levels in L, LA, RGB or RGBA. Bilevel images
+    # become 0 and 255, wider grayscale modes are clipped to 0..255, and
+    # palette and other colour modes are converted to RGB, or RGBA when
+    # they carry transparency.
+    if image.mode in ("L", "LA", "RGB", "RGBA"):
         return image
-    
-    grayscale = np.dot(image_array[..., :3], [0.2989, 0.5870, 0.1140])
-    grayscale_uint8 = np.clip(grayscale, 0, 255).astype(np.uint8)
-    return Image.fromarray(grayscale_uint8)
-
-def binary(image, threshold):
-    image_array = np.array(grayscale(image))    
-    binary_image = np.where(image_array > threshold, 255, 0)
-    return Image.fromarray(binary_image.astype(np.uint8))
+    if image.mode in ("1", "F") or image.mode.startswith("I"):
+        return image.convert("L")
+    if "A" in image.mode.upper() or "transparency" in image.info:
+        return image.convert("RGBA")
+    return image.convert("RGB")
+
+def _uint8_array(array):
+    # The same for arrays: booleans become 0 and 255, other types are
+    # clipped to 0..255.
+    if array.dtype == np.bool_:
+        return array.astype(np.uint8) * np.uint8(255)
+    if array.dtype != np.uint8:
+        return np.clip(array, 0, 255).astype(np.uint8)
+    return array
+
+def _read_only(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    return value
+
+def image_context(image):
+    return image if isinstance(image, ImageContext) else ImageContext(image)
+
+def image_filter(function):
+    # The filters compute a uint8 array; this hands it back as the kind of
+    # image they were given: a context for a context, an array for an array
+    # and a PIL image for a PIL image.
+    @functools.wraps(function)
+    def wrapper(image, *args, **kwargs):
+        result = function(image, *args, **kwargs)
+        if isinstance(image, ImageContext):
+            return ImageContext(result, image.original_size)
+        if isinstance(image, np.ndarray):
+            return result
+        return Image.fromarray(result)
+    return wrapper
+
+def _float_dtype():
+    return np.float32 if COMPACT else np.float64
+
+def _sum_dtype(bound):
+    # Smallest signed type that holds sums up to bound.
+    for dtype in (np.int16, np.int32):
+        if bound < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+def _bands(rows, cols):
+    step = max(1, _BAND_PIXELS // max(cols, 1))
+    for top in range(0, rows, step):
+        yield top, min(top + step, rows)
+
+def _output(shape, out):
+    return np.empty(shape, dtype=np.uint8) if out is None else out
+
+@instrumented("clip")
+def _store(values, out, top, bottom):
+    # Clips in place, so values must be a temporary.
+    np.clip(values, 0, 255, out=values)
+    np.copyto(out[top:bottom], values, casting='unsafe')
+
+def _grayscale_array(image_array):
+    grayscale = np.empty(image_array.shape[:2], dtype=np.uint8)
+    for top, bottom in _bands(*image_array.shape[:2]):
+        band = image_array[top:bottom, :, :3].astype(float)
+        _store(np.dot(band, [0.2989, 0.5870, 0.1140]), grayscale, top, bottom)
+    return grayscale
+
+@image_filter
+def grayscale(image, *args, out=None):
+    context = image_context(image).grayscale()
+    if out is None:
+        return context.array
+    np.copyto(out, context.array)
+    return out
+
+# Every uint8 input value, used to turn the pointwise filters into 256-entry
+# lookup tables computed with the same float arithmetic as before.
+_LEVELS = np.arange(256, dtype=float)
+
+def brightness_lut(value):
+    return np.clip(_LEVELS + value, 0, 255).astype(np.uint8)
+
+def contrast_lut(value):
+    return np.clip(value * (_LEVELS - 128) + 128, 0, 255).astype(np.uint8)
+
+def negative_lut(*args):
+    return np.clip(255 - _LEVELS, 0, 255).astype(np.uint8)
+
+def threshold_lut(threshold):
+    return np.where(_LEVELS > threshold, 255, 0).astype(np.uint8)
+
+def _apply_lut(image, lut, out=None):
+    image_array = image_context(image).array
+    with stage("lookup"):
+        if out is None:
+            out = lut[image_array]
+        else:
+            for top, bottom in _bands(*image_array.shape[:2]):
+                out[top:bottom] = lut[image_array[top:bottom]]
+    return out
+
+@image_filter
+def binary(image, threshold, out=None):
+    return _apply_lut(image_context(image).grayscale(), threshold_lut(threshold), out)
         
-def brightness_correction(image, value):
-    image_array = np.array(image).astype(float)
-    brightness_increased = np.clip(image_array + value, 0, 255).astype(np.uint8)
-    return Image.fromarray(brightness_increased)
-
-def contrast_correction(image, value):
-    image_array = np.array(image).astype(float)
-    contrast_corrected = np.clip(value * (image_array - 128) + 128, 0, 255).astype(np.uint8)
-    return Image.fromarray(contrast_corrected)
-
-def negative_filter(image, *args):
-    image_array = np.array(image).astype(float)
-    negative_image = np.clip(255 - image_array, 0, 255).astype(np.uint8)
-    return Image.fromarray(negative_image)
-
-def binarisation(image, threshold):
-    image_array = np.array(image).astype(float)
-    binary_image = np.where(image_array > threshold, 255, 0).astype(np.uint8)
-    return Image.fromarray(binary_image)
-
-def averaging(image, kernel_size):
-    image_array = np.array(image).astype(float)
+@image_filter
+def brightness_correction(image, value, out=None):
+    return _apply_lut(image, brightness_lut(value), out)
+
+@image_filter
+def contrast_correction(image, value, out=None):
+    return _apply_lut(image, contrast_lut(value), out)
+
+@image_filter
+def negative_filter(image, *args, out=None):
+    return _apply_lut(image, negative_lut(), out)
+
+@image_filter
+def binarisation(image, threshold, out=None):
+    return _apply_lut(image, threshold_lut(threshold), out)
+
+def _pad(image_array, before, after, mode):
+    pad_width = ((before, after), (before, after)) + ((0, 0),) * (image_array.ndim - 2)
+    if mode == 'constant':
+        return np.pad(image_array, pad_width, mode='constant', constant_values=0)
+    return np.pad(image_array, pad_width, mode=mode)
+
+def _pairwise_sum(term, n):
+    # Same association order as numpy's pairwise summation, so the result
+    # matches np.sum(region * kernel) bit for bit.
+    if n < 8:
+        result = term(0)
+        for i in range(1, n):
+            result += term(i)
+        return result
+    elif n < 16:
+        # A single block of eight: the partial sums are the terms themselves,
+        # so the tree is built as they come and at most three are alive.
+        def pair(i):
+            total = term(i)
+            total += term(i + 1)
+            return total
+        result = pair(0)
+        result += pair(2)
+        upper = pair(4)
+        upper += pair(6)
+        result += upper
+        for i in range(8, n):
+            result += term(i)
+        return result
+    elif n <= 128:
+        partial = [term(i) for i in range(8)]
+        i = 8
+        while i < n - (n % 8):
+            for j in range(8):
+                partial[j] += term(i + j)
+            i += 8
+        result = (partial[0] + partial[1]) + (partial[2] + partial[3])
+        result += (partial[4] + partial[5]) + (partial[6] + partial[7])
+        for i in range(i, n):
+            result += term(i)
+        return result
+    else:
+        half = n // 2
+        half -= half % 8
+        return _pairwise_sum(term, half) + _pairwise_sum(lambda i: term(half + i), n - half)
+
+def _convolve(padded_image, kernel, shape):
+    rows, cols = shape[0], shape[1]
+    kernel_width = kernel.shape[1]
+
+    def term(n):
+        a, b = divmod(n, kernel_width)
+        return padded_image[a:a+rows, b:b+cols] * kernel[a, b]
+
+    return _pairwise_sum(term, kernel.size)
+
+def _accumulate(windows, weights, dtype):
+    # Sums weight * window in order, in place, skipping zero weights. Unit
+    # weights add or subtract without a multiply, which is exact.
+    result = term = None
+    for window, weight in zip(windows, weights):
+        if not weight:
+            continue
+        if result is None:
+            result = np.multiply(window, weight, dtype=dtype)
+        elif weight == 1:
+            np.add(result, window, out=result)
+        elif weight == -1:
+            np.subtract(result, window, out=result)
+        else:
+            if term is None:
+                term = np.empty_like(result)
+            np.multiply(window, weight, out=term, dtype=dtype)
+            result += term
+    return result
+
+def _separable_correlate(padded_image, column_weights, row_weights, shape, dtype=np.float64):
+    rows, cols = shape[0], shape[1]
+    vertical = _accumulate((padded_image[a:a+rows] for a in range(len(column_weights))), column_weights, dtype)
+    return _accumulate((vertical[:, b:b+cols] for b in range(len(row_weights))), row_weights, dtype)
+
+def _kernel_image(context, kernel, mode, out):
+    rows, cols = context.shape[:2]
+    padded_image = context.padded(1, mode)
+    out = _output(context.shape, out)
+
+    # Integer kernels on uint8 data are exact in a narrow integer type, in
+    # any order. Fractional ones keep numpy's summation order.
+    integer = np.array_equal(kernel, np.round(kernel))
+    weights = kernel.astype(np.int64).ravel()
+    dtype = _sum_dtype(np.abs(weights).sum() * 255)
+
+    for top, bottom in _bands(rows, cols):
+        band = padded_image[top:bottom + 2]
+        shape = (bottom - top,) + context.shape[1:]
+        with stage("kernel"):
+            if integer:
+                windows = (band[a:a+shape[0], b:b+cols] for a in range(3) for b in range(3))
+                values = _accumulate(windows, weights, dtype)
+            else:
+                values = _convolve(band, kernel.astype(_float_dtype()), shape)
+        _store(values, out, top, bottom)
+
+    return out
+
+def _integral_image(image_array, dtype=np.int64):
+    # In a narrow type the table wraps around, but box sums taken from it are
+    # still exact as long as they fit in that type.
+    integral = np.zeros((image_array.shape[0] + 1, image_array.shape[1] + 1) + image_array.shape[2:], dtype=dtype)
+    np.cumsum(image_array, axis=0, dtype=dtype, out=integral[1:, 1:])
+    np.cumsum(integral[1:, 1:], axis=1, out=integral[1:, 1:])
+    return integral
+
+def _box_sum(integral, height, width, shape):
+    rows, cols = shape[0], shape[1]
+    total = integral[height:height+rows, width:width+cols] - integral[:rows, width:width+cols]
+    total -= integral[height:height+rows, :cols]
+    total += integral[:rows, :cols]
+    return total
+
+@image_filter
+def averaging(image, kernel_size, out=None):
+    context = image_context(image)
     
     kernel_size = int(kernel_size)
-    kernel = np.ones((kernel_size, kernel_size)) / (kernel_size * kernel_size)
+    area = kernel_size * kernel_size
     
-    if image_array.ndim == 3:
-        padded_image = np.pad(image_array, ((kernel_size // 2, kernel_size // 2), 
-                                            (kernel_size // 2, kernel_size // 2), 
-                                            (0, 0)), 
-                              mode='constant', constant_values=0)
-        averaged_image = np.zeros_like(image_array)
-        
-        for i in range(image_array.shape[0]):
-            for j in range(image_array.shape[1]):
-                for k in range(image_array.shape[2]):
-                    averaged_image[i, j, k] = np.sum(padded_image[i:i+kernel_size, j:j+kernel_size, k] * kernel)
-    else:
-        padded_image = np.pad(image_array, ((kernel_size // 2, kernel_size // 2), 
-                                            (kernel_size // 2, kernel_size // 2)), 
-                              mode='constant', constant_values=0)
-        averaged_image = np.zeros_like(image_array)
-        
-        for i in range(image_array.shape[0]):
-            for j in range(image_array.shape[1]):
-                averaged_image[i, j] = np.sum(padded_image[i:i+kernel_size, j:j+kernel_size] * kernel)
+    integral = context.integral(kernel_size // 2, 'constant', dtype=_sum_dtype(area * 255))
+    rows, cols = context.shape[:2]
+    out = _output(context.shape, out)
+    for top, bottom in _bands(rows, cols):
+        with stage("kernel"):
+            window_sums = _box_sum(integral[top:], kernel_size, kernel_size, (bottom - top, cols))
+            # Sums are non-negative, so floor division truncates like the float mean.
+            window_sums //= area
+        _store(window_sums, out, top, bottom)
     
-    return Image.fromarray(np.clip(averaged_image, 0, 255).astype(np.uint8))
-
-def median(image, kernel_size):
-    image_array = np.array(image).astype(float)
+    return out
+
+_CUMULATIVE = np.tril(np.ones((16, 16), dtype=np.float32))
+
+# Padded columns are turned into histogram indices this many at a time.
+_MEDIAN_STRIP = 64
+
+def _order_statistic(histogram, coarse, rank, columns):
+    # Two-level search: find the 16-value bucket holding the rank from the
+    # coarse counts, then the value inside it, so only 32 counts are
+    # scanned per sample.
+    count = histogram.shape[1]
+    cumulative = _CUMULATIVE @ coarse
+    buckets = (cumulative <= rank).sum(axis=0)
+    remaining = rank - np.where(buckets > 0, cumulative[buckets - 1, columns], 0)
+    fine = histogram.ravel().take(buckets * (16 * count) + columns + (np.arange(16) * count)[:, None])
+    return buckets * 16 + (_CUMULATIVE @ fine.astype(np.float32) <= remaining).sum(axis=0)
+
+@instrumented("kernel")
+def _histogram_median(padded_plane, kernel_size, out):
+    # Huang-style sliding histogram over one channel: one 256-bin histogram
+    # per output row, updated with the entering and leaving window columns
+    # as the window moves right. Every row slides in the same pass. Channels
+    # go one at a time; one histogram for all of them is slower, as it no
+    # longer stays in cache.
+    #
+    # The cost is O(kernel_size) per sample, and updates run at about 7 ns
+    # per sample and window row. On one core, a 3840x2160 grayscale image
+    # takes about 2.5 s at kernel size 3 and 6 s at 31, and RGB three times
+    # as long. That is well short of interactive at 4K.
+    rows, cols = out.shape
+    columns = np.arange(rows)
+
+    # Counts go up to kernel_size**2. Window row t of output row r is padded
+    # row r + t, so a padded column is turned into indices once, as
+    # value * rows + padded row, and row t reads the histogram shifted by t.
+    size = kernel_size * kernel_size
+    dtype = np.int16 if size < 2**15 else np.int32
+    storage = np.zeros(kernel_size + 256 * rows, dtype=dtype)
+    histogram = storage[kernel_size:].reshape(256, rows)
+    shifted = [storage[kernel_size - t:] for t in range(kernel_size)]
+    positions = np.arange(padded_plane.shape[0])
+
+    def padded_columns():
+        for left in range(0, padded_plane.shape[1], _MEDIAN_STRIP):
+            strip = np.ascontiguousarray(padded_plane[:, left:left + _MEDIAN_STRIP].T, dtype=np.intp)
+            strip *= rows
+            strip += positions
+            yield from strip
+
+    def update(indices, delta):
+        for t, view in enumerate(shifted):
+            view[indices[t:t + rows]] += delta
+
+    entering, leaving = padded_columns(), padded_columns()
+    for _ in range(kernel_size):
+        update(next(entering), 1)
+
+    for j in range(cols):
+        if j:
+            update(next(leaving), -1)
+            update(next(entering), 1)
+        coarse = histogram.reshape(16, 16, rows).sum(axis=1, dtype=dtype).astype(np.float32)
+        if size % 2:
+            out[:, j] = _order_statistic(histogram, coarse, size // 2, columns)
+        else:
+            lower = _order_statistic(histogram, coarse, size // 2 - 1, columns)
+            upper = _order_statistic(histogram, coarse, size // 2, columns)
+            out[:, j] = (lower + upper) // 2
+
+@image_filter
+def median(image, kernel_size, out=None):
+    context = image_context(image)
     kernel_size = int(kernel_size)
 
-    if image_array.ndim == 3:
-        padded_image = np.pad(image_array, ((kernel_size // 2, kernel_size // 2), 
-                                            (kernel_size // 2, kernel_size // 2), 
-                                            (0, 0)), 
-                              mode='constant', constant_values=0)
-        median_filtered_image = np.zeros_like(image_array)
-        
-        for i in range(image_array.shape[0]):
-            for j in range(image_array.shape[1]):
-                for k in range(image_array.shape[2]):
-                    median_filtered_image[i, j, k] = np.median(padded_image[i:i+kernel_size, j:j+kernel_size, k])
-    else: 
-        padded_image = np.pad(image_array, ((kernel_size // 2, kernel_size // 2), 
-                                            (kernel_size // 2, kernel_size // 2)), 
-                              mode='constant', constant_values=0)
-        median_filtered_image = np.zeros_like(image_array)
-        
-        for i in range(image_array.shape[0]):
-            for j in range(image_array.shape[1]):
-                region = padded_image[i:i+kernel_size, j:j+kernel_size]
-                median_filtered_image[i, j] = np.median(region)
-    
-    return Image.fromarray(np.clip(median_filtered_image, 0, 255).astype(np.uint8))
-
-def gaussian(image, sigma):
+    padded_image = context.padded(kernel_size // 2, 'constant')
+    out = _output(context.shape, out)
+    if out.ndim == 2:
+        _histogram_median(padded_image, kernel_size, out)
+    else:
+        for channel in range(out.shape[2]):
+            _histogram_median(padded_image[..., channel], kernel_size, out[..., channel])
+
+    return out
+
+def _recursive_gaussian_coefficients(sigma):
+    # Fourth-order Deriche approximation of the Gaussian, with the fitted
+    # constants from Farneback and Westin (2006), normalised to unit DC gain.
+    a0, a1, b0, b1, c0, c1, w0, w1 = 1.6797, 3.7340, 1.7831, 1.7230, -0.6803, -0.2598, 0.6318, 1.9969
+    e0, e1 = np.exp(-b0 / sigma), np.exp(-b1 / sigma)
+    cos0, cos1 = np.cos(w0 / sigma), np.cos(w1 / sigma)
+    sin0, sin1 = np.sin(w0 / sigma), np.sin(w1 / sigma)
+
+    n0 = a0 + c0
+    n1 = e1 * (c1 * sin1 - (c0 + 2 * a0) * cos1) + e0 * (a1 * sin0 - (2 * c0 + a0) * cos0)
+    n2 = (2 * e0 * e1 * ((a0 + c0) * cos1 * cos0 - a1 * cos1 * sin0 - c1 * cos0 * sin1)
+          + c0 * e0**2 + a0 * e1**2)
+    n3 = e1 * e0**2 * (c1 * sin1 - c0 * cos1) + e0 * e1**2 * (a1 * sin0 - a0 * cos0)
+    d1 = -2 * e1 * cos1 - 2 * e0 * cos0
+    d2 = 4 * cos1 * cos0 * e0 * e1 + e1**2 + e0**2
+    d3 = -2 * cos0 * e0 * e1**2 - 2 * cos1 * e1 * e0**2
+    d4 = (e0 * e1)**2
+
+    causal = np.array([n0, n1, n2, n3])
+    anticausal = np.array([n1 - d1 * n0, n2 - d2 * n0, n3 - d3 * n0, -d4 * n0])
+    feedback = np.array([d1, d2, d3, d4])
+    gain = (causal.sum() + anticausal.sum()) / (1 + feedback.sum())
+    return causal / gain, anticausal / gain, feedback
+
+def _recursive_pass(lines, order, inputs, feedback, edge, include_current):
+    # The causal pass reads x[n]..x[n-3]; the anti-causal pass reads x[n+1]..x[n+4].
+    filtered = np.empty_like(lines)
+    previous_inputs = [lines[order[0]]] * 4
+    previous_outputs = [lines[order[0]] * edge] * 4
+
+    for n in order:
+        if include_current:
+            previous_inputs = [lines[n]] + previous_inputs[:3]
+        value = (sum(weight * x for weight, x in zip(inputs, previous_inputs))
+                 - sum(weight * y for weight, y in zip(feedback, previous_outputs)))
+        filtered[n] = value
+        previous_outputs = [value] + previous_outputs[:3]
+        if not include_current:
+            previous_inputs = [lines[n]] + previous_inputs[:3]
+
+    return filtered
+
+def _recursive_smooth(image_array, sigma, axis):
+    causal, anticausal, feedback = (coefficients.astype(image_array.dtype)
+                                    for coefficients in _recursive_gaussian_coefficients(sigma))
+    lines = np.moveaxis(image_array, axis, 0)
+    steady_state = 1 + feedback.sum()
+
+    # Both passes start from the steady state of the edge sample, so flat
+    # borders stay flat.
+    forward = _recursive_pass(lines, range(lines.shape[0]), causal, feedback,
+                              causal.sum() / steady_state, True)
+    backward = _recursive_pass(lines, range(lines.shape[0] - 1, -1, -1), anticausal, feedback,
+                               anticausal.sum() / steady_state, False)
+    return np.moveaxis(forward + backward, 0, axis)
+
+@image_filter
+def gaussian(image, sigma, method='separable', out=None):
+    return _gaussian_image(image_context(image), sigma, method, out)
+
+@image_filter
+def recursive_gaussian(image, sigma, out=None):
+    # The recursive filter, for large sigmas, where the separable kernel's
+    # 6 sigma taps get slow.
+    return _gaussian_image(image_context(image), sigma, 'recursive', out)
+
+def _gaussian_image(context, sigma, method, out):
     def gaussian_kernel(size, sigma):
         ax = np.linspace(-(size // 2), size // 2, size)
         kernel = np.exp(-0.5 * (ax / sigma) ** 2)
-        kernel = np.outer(kernel, kernel)
         return kernel / np.sum(kernel)
 
-    image_array = np.array(image).astype(float)
+    rows, cols = context.shape[:2]
+    dtype = _float_dtype()
     
     size = int(6 * sigma) | 1
-    kernel = gaussian_kernel(size, sigma)
-    
-    if image_array.ndim == 3:
-        padded_image = np.pad(image_array, ((size // 2, size // 2), 
-                                            (size // 2, size // 2), 
-                                            (0, 0)), 
-                              mode='reflect')
-        blurred_image = np.zeros_like(image_array)
-
-        for i in range(image_array.shape[0]):
-            for j in range(image_array.shape[1]):
-                for k in range(image_array.shape[2]):
-                    blurred_image[i, j, k] = np.sum(padded_image[i:i+size, j:j+size, k] * kernel)
+    padded_image = context.padded(size // 2, 'reflect')
+    out = _output(context.shape, out)
+
+    # The recursive filter does the same work per sample for every sigma,
+    # but it runs over the image reflect-padded by 3 sigma on each side, so
+    # its time still grows with sigma, if slowly. Against the exact kernel its
+    # impulse response peaks within 0.05% for sigma 0.5 to 20, and uint8
+    # outputs differ by at most one level. Smaller sigmas use the exact
+    # kernel.
+    if method == 'recursive' and sigma >= 0.5:
+        with stage("kernel"):
+            blurred_image = padded_image.astype(dtype)
+            blurred_image = _recursive_smooth(_recursive_smooth(blurred_image, sigma, 0), sigma, 1)
+            # Rounded rather than truncated: flat areas come out within
+            # float noise of their level, on either side of it.
+            np.rint(blurred_image, out=blurred_image)
+        _store(blurred_image[size // 2:size // 2 + rows, size // 2:size // 2 + cols], out, 0, rows)
     else:
-        padded_image = np.pad(image_array, ((size // 2, size // 2), 
-                                            (size // 2, size // 2)), 
-                              mode='reflect')
-        blurred_image = np.zeros_like(image_array)
-
-        for i in range(image_array.shape[0]):
-            for j in range(image_array.shape[1]):
-                blurred_image[i, j] = np.sum(padded_image[i:i+size, j:j+size] * kernel)
+        kernel = gaussian_kernel(size, sigma).astype(dtype)
+        for top, bottom in _bands(rows, cols):
+            with stage("kernel"):
+                blurred_image = _separable_correlate(padded_image[top:bottom + size - 1], kernel, kernel,
+                                                     (bottom - top, cols), dtype)
+            _store(blurred_image, out, top, bottom)
     
-    return Image.fromarray(np.clip(blurred_image, 0, 255).astype(np.uint8))
+    return out
 
-def sharpening(image, value):
-    image_array = np.array(image).astype(float)
-    
+@image_filter
+def sharpening(image, value, out=None):
     kernel = np.array([[0, -1, 0], [-1, value, -1], [0, -1, 0]])
-
-    if image_array.ndim == 3:
-        padded_image = np.pad(image_array, ((1, 1), (1, 1), (0, 0)), mode='constant', constant_values=0)
-        sharpened_image = np.zeros_like(image_array)
-
-        for i in range(image_array.shape[0]):
-            for j in range(image_array.shape[1]):
-                for k in range(image_array.shape[2]):
-                    sharpened_image[i, j, k] = np.sum(padded_image[i:i+3, j:j+3, k] * kernel)
-
+    return _kernel_image(image_context(image), kernel, 'constant', out)
+
+# (smoothing weights, derivative weights, padding mode); gx smooths down the
+# columns and differentiates along the rows, gy the other way round. Roberts
+# is not separable and is handled directly.
+_GRADIENT_OPERATORS = {
+    'roberts': (None, None, 'constant'),
+    'sobel': ((1, 2, 1), (1, 0, -1), 'constant'),
+    'prewitt': ((1, 1, 1), (-1, 0, 1), 'reflect'),
+    'ridge': ((1, 2, 1), (-1, 0, 1), 'reflect'),
+    'scharr': ((3, 10, 3), (1, 0, -1), 'reflect'),
+}
+
+def _gradient_components(padded_image, operator, shape):
+    # Exact in int16: the largest response is 16 * 2 * 255, for Scharr.
+    smoothing, derivative = _GRADIENT_OPERATORS[operator][:2]
+    if operator == 'roberts':
+        rows, cols = shape
+        gx = np.subtract(padded_image[:rows, :cols], padded_image[1:rows+1, 1:cols+1], dtype=np.int16)
+        gy = np.subtract(padded_image[:rows, 1:cols+1], padded_image[1:rows+1, :cols], dtype=np.int16)
     else:
-        padded_image = np.pad(image_array, ((1, 1), (1, 1)), mode='constant', constant_values=0)
-        sharpened_image = np.zeros_like(image_array)
-
-        for i in range(image_array.shape[0]):
-            for j in range(image_array.shape[1]):
-                sharpened_image[i, j] = np.sum(padded_image[i:i+3, j:j+3] * kernel)
-
-    sharpened_image = np.clip(sharpened_image, 0, 255)
-
-    return Image.fromarray(sharpened_image.astype(np.uint8))
-
-def roberts(image, *args):
-    image_array = np.array(image).astype(float)
-
-    if image_array.ndim == 3:
-        image_array = np.array(grayscale(image)).astype(float)
-    
-    kernel_x = np.array([[1, 0], [0, -1]])
-    kernel_y = np.array([[0, 1], [-1, 0]])
-    
-    padded_image = np.pad(image_array, ((1, 1), (1, 1)), mode='constant', constant_values=0)
-    edges = np.zeros_like(image_array)
-
-    for i in range(image_array.shape[0]):
-        for j in range(image_array.shape[1]):
-            gx = np.sum(padded_image[i:i+2, j:j+2] * kernel_x)
-            gy = np.sum(padded_image[i:i+2, j:j+2] * kernel_y)
-            edges[i, j] = np.sqrt(gx**2 + gy**2)
-
-    return Image.fromarray(np.clip(edges, 0, 255).astype(np.uint8))
-
-def sobel(image, *args):
-    image_array = np.array(image).astype(float)
-
-    if image_array.ndim == 3:
-        image_array = np.array(grayscale(image)).astype(float)    
-    kernel_x = np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]])
-    kernel_y = np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]])
-    
-    padded_image = np.pad(image_array, ((1, 1), (1, 1)), mode='constant', constant_values=0)
-    edges = np.zeros_like(image_array)
-
-    for i in range(image_array.shape[0]):
-        for j in range(image_array.shape[1]):
-            gx = np.sum(padded_image[i:i+3, j:j+3] * kernel_x)
-            gy = np.sum(padded_image[i:i+3, j:j+3] * kernel_y)
-            edges[i, j] = np.sqrt(gx**2 + gy**2)
-
-    return Image.fromarray(np.clip(edges, 0, 255).astype(np.uint8))
-
-def high_pass(image, value):
-    image_array = np.array(image).astype(float)
-    if image_array.ndim == 3:
-        image_array = np.array(grayscale(image)).astype(float) 
-
+        gx = _separable_correlate(padded_image, smoothing, derivative, shape, np.int16)
+        gy = _separable_correlate(padded_image, derivative, smoothing, shape, np.int16)
+    return gx, gy
+
+def gradients(image, operator='sobel'):
+    context = image_context(image).grayscale()
+    padded_image = context.padded(1, _GRADIENT_OPERATORS[operator][2])
+    gx, gy = (component.astype(float) for component in _gradient_components(padded_image, operator, context.shape))
+
+    magnitude = np.sqrt(gx**2 + gy**2)
+    return gx, gy, magnitude, np.arctan2(gy, gx)
+
+def _edge_image(image, operator, out):
+    context = image_context(image).grayscale()
+    rows, cols = context.shape
+    padded_image = context.padded(1, _GRADIENT_OPERATORS[operator][2])
+    out = _output(context.shape, out)
+
+    for top, bottom in _bands(rows, cols):
+        with stage("kernel"):
+            gx, gy = _gradient_components(padded_image[top:bottom + 2], operator, (bottom - top, cols))
+            squares = np.square(gx, dtype=np.int32)
+            squares += np.square(gy, dtype=np.int32)
+            # Up to 255**2 a float32 root truncates to the same level as a
+            # float64 one: a non-square sum is at least 1/512 from an integer root.
+            magnitude = np.sqrt(squares, dtype=np.float32)
+        _store(magnitude, out, top, bottom)
+
+    return out
+
+@image_filter
+def roberts(image, *args, out=None):
+    return _edge_image(image, 'roberts', out)
+
+@image_filter
+def sobel(image, *args, out=None):
+    return _edge_image(image, 'sobel', out)
+
+@image_filter
+def high_pass(image, value, out=None):
     kernel = np.array([
         [-1, -1, -1],
         [-1,  value, -1],
         [-1, -1, -1]
     ])
 
-    padded_image = np.pad(image_array, ((1, 1), (1, 1)), mode='reflect')
-    filtered_image = np.zeros_like(image_array)
-
-    for i in range(image_array.shape[0]):
-        for j in range(image_array.shape[1]):
-            region = padded_image[i:i+3, j:j+3]
-            filtered_image[i, j] = np.sum(region * kernel)
+    return _kernel_image(image_context(image).grayscale(), kernel, 'reflect', out)
 
-    return Image.fromarray(np.clip(filtered_image, 0, 255).astype(np.uint8))
-
-def laplace(image, *args):
-    image_array = np.array(image).astype(float)
-
-    if image_array.ndim == 3:
-        image_array = np.array(grayscale(image)).astype(float)  
+@image_filter
+def laplace(image, *args, out=None):
     kernel = np.array([
         [0,  1,  0],
         [1, -4,  1],
         [0,  1,  0]
     ])
 
-    padded_image = np.pad(image_array, ((1, 1), (1, 1)), mode='reflect')
-    filtered_image = np.zeros_like(image_array)
-
-    for i in range(image_array.shape[0]):
-        for j in range(image_array.shape[1]):
-            region = padded_image[i:i+3, j:j+3]
-            filtered_image[i, j] = np.sum(region * kernel)
-
-    return Image.fromarray(np.clip(filtered_image, 0, 255).astype(np.uint8))
-
-def prewitt(image, *args):
-    image_array = np.array(image).astype(float)
-
-    if image_array.ndim == 3:
-        image_array = np.array(grayscale(image)).astype(float) 
-        
-    kernel_x = np.array([
-        [-1, 0, 1],
-        [-1, 0, 1],
-        [-1, 0, 1]
-    ])
-
-    kernel_y = np.array([
-        [-1, -1, -1],
-        [ 0,  0,  0],
-        [ 1,  1,  1]
-    ])
+    return _kernel_image(image_context(image).grayscale(), kernel, 'reflect', out)
 
-    padded_image = np.pad(image_array, ((1, 1), (1, 1)), mode='reflect')
-    filtered_image_x = np.zeros_like(image_array)
-    filtered_image_y = np.zeros_like(image_array)
+@image_filter
+def prewitt(image, *args, out=None):
+    return _edge_image(image, 'prewitt', out)
 
-    for i in range(image_array.shape[0]):
-        for j in range(image_array.shape[1]):
-            region = padded_image[i:i+3, j:j+3]
-            filtered_image_x[i, j] = np.sum(region * kernel_x)
-            filtered_image_y[i, j] = np.sum(region * kernel_y)
-
-    filtered_image = np.sqrt(filtered_image_x**2 + filtered_image_y**2)
-    return Image.fromarray(np.clip(filtered_image, 0, 255).astype(np.uint8))
-
-def kuwahara(image, kernel_size):
-    image_array = np.array(image).astype(float)
+@image_filter
+def kuwahara(image, kernel_size, luminance=False, out=None):
+    context = image_context(image)
+    rows, cols = context.shape[:2]
     kernel_size = int(kernel_size)
     offset = kernel_size // 2
-
-    if image_array.ndim == 3:
-        padded_image = np.pad(image_array, ((offset, offset), (offset, offset), (0, 0)), mode='reflect')
-        filtered_image = np.zeros_like(image_array)
-
-        for i in range(image_array.shape[0]):
-            for j in range(image_array.shape[1]):
-                for k in range(image_array.shape[2]):
-                    regions = [
-                        padded_image[i:i+offset+1, j:j+offset+1, k],
-                        padded_image[i:i+offset+1, j+offset:j+kernel_size, k],
-                        padded_image[i+offset:i+kernel_size, j:j+offset+1, k],
-                        padded_image[i+offset:i+kernel_size, j+offset:j+kernel_size, k]
-                    ]
-                    means = [np.mean(region) for region in regions]
-                    variances = [np.var(region) for region in regions]
-                    min_variance_index = np.argmin(variances)
-                    filtered_image[i, j, k] = means[min_variance_index]
-    else:
-        padded_image = np.pad(image_array, ((offset, offset), (offset, offset)), mode='reflect')
-        filtered_image = np.zeros_like(image_array)
-
-        for i in range(image_array.shape[0]):
-            for j in range(image_array.shape[1]):
-                regions = [
-                    padded_image[i:i+offset+1, j:j+offset+1],
-                    padded_image[i:i+offset+1, j+offset:j+kernel_size],
-                    padded_image[i+offset:i+kernel_size, j:j+offset+1],
-                    padded_image[i+offset:i+kernel_size, j+offset:j+kernel_size]
-                ]
-                means = [np.mean(region) for region in regions]
-                variances = [np.var(region) for region in regions]
-                min_variance_index = np.argmin(variances)
-                filtered_image[i, j] = means[min_variance_index]
-
-    return Image.fromarray(np.clip(filtered_image, 0, 255).astype(np.uint8))
-
-def ridge(image, *args):
-    image_array = np.array(grayscale(image)).astype(float)
-    kernel_x = np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]])
-    kernel_y = np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]])
-    
-    padded_image = np.pad(image_array, ((1, 1), (1, 1)), mode='reflect')
-    filtered_image_x = np.zeros_like(image_array)
-    filtered_image_y = np.zeros_like(image_array)
-
-    for i in range(image_array.shape[0]):
-        for j in range(image_array.shape[1]):
-            filtered_image_x[i, j] = np.sum(padded_image[i:i+3, j:j+3] * kernel_x)
-            filtered_image_y[i, j] = np.sum(padded_image[i:i+3, j:j+3] * kernel_y)
-
-    filtered_image = np.sqrt(filtered_image_x**2 + filtered_image_y**2)
-    return Image.fromarray(np.clip(filtered_image, 0, 255).astype(np.uint8))
-
-def scharr(image, *args):
-    image_array = np.array(grayscale(image)).astype(float)
-    kernel_x = np.array([
-        [3, 0, -3],
-        [10, 0, -10],
-        [3, 0, -3]
-    ])
-    kernel_y = np.array([
-        [3, 10, 3],
-        [0, 0, 0],
-        [-3, -10, -3]
-    ])
-    
-    padded_image = np.pad(image_array, ((1, 1), (1, 1)), mode='reflect')
-    filtered_image_x = np.zeros_like(image_array)
-    filtered_image_y = np.zeros_like(image_array)
-
-    for i in range(image_array.shape[0]):
-        for j in range(image_array.shape[1]):
-            filtered_image_x[i, j] = np.sum(padded_image[i:i+3, j:j+3] * kernel_x)
-            filtered_image_y[i, j] = np.sum(padded_image[i:i+3, j:j+3] * kernel_y)
-
-    filtered_image = np.sqrt(filtered_image_x**2 + filtered_image_y**2)
-    return Image.fromarray(np.clip(filtered_image, 0, 255).astype(np.uint8))
+    quadrants = ((0, offset + 1), (offset, kernel_size - offset))
+    largest = (offset + 1) ** 2
+
+    # Every quantity below is an integer bounded by the largest quadrant, so
+    # it is computed exactly in the narrowest type that holds it.
+    sums = context.integral(offset, 'reflect', dtype=_sum_dtype(largest * 255))
+
+    # In luminance mode the quadrant is chosen once per pixel from the
+    # grayscale image and the same quadrant is used for every channel.
+    guide = context.grayscale() if luminance else context
+    guide_sums = guide.integral(offset, 'reflect', dtype=_sum_dtype(largest * 255))
+    guide_squares = guide.integral(offset, 'reflect', squares=True, dtype=_sum_dtype(largest * 255**2))
+    spread_dtype = _sum_dtype(largest * largest * 255**2)
+
+    out = _output(context.shape, out)
+    for band_top, band_bottom in _bands(rows, cols):
+        shape = (band_bottom - band_top, cols)
+        filtered_image = None
+        with stage("kernel"):
+            for top, height in quadrants:
+                for left, width in quadrants:
+                    count = height * width
+                    total = _box_sum(guide_sums[band_top + top:, left:], height, width, shape)
+                    total_squares = _box_sum(guide_squares[band_top + top:, left:], height, width, shape)
+                    # count**2 times the variance. With an odd kernel all four
+                    # quadrants have the same count, so it compares the same way.
+                    variance = np.multiply(total_squares, count, dtype=spread_dtype)
+                    variance -= np.square(total, dtype=spread_dtype)
+                    if kernel_size % 2 == 0:
+                        # Equal variances still divide to equal floats.
+                        variance = variance / (count * count)
+                    mean = _box_sum(sums[band_top + top:, left:], height, width, shape)
+                    mean //= count
+
+                    # Variances are compared exactly, and where several
+                    # quadrants share the smallest the first one (top left,
+                    # top right, bottom left, bottom right) wins. The float
+                    # np.var of the original broke those ties by rounding
+                    # noise instead, so where tied quadrants have different
+                    # means the output differs from it, by up to the spread of
+                    # the means. On images with a few levels that is up to a
+                    # few percent of samples; reproducing np.var's rounding
+                    # made the filter up to twice as slow.
+                    if filtered_image is None:
+                        min_variance, filtered_image = variance, mean
+                    else:
+                        smaller = variance < min_variance
+                        np.copyto(min_variance, variance, where=smaller)
+                        if smaller.ndim < filtered_image.ndim:
+                            smaller = smaller[..., np.newaxis]
+                        np.copyto(filtered_image, mean, where=smaller)
+
+        _store(filtered_image, out, band_top, band_bottom)
+
+    return out
+
+@image_filter
+def ridge(image, *args, out=None):
+    return _edge_image(image, 'ridge', out)
+
+@image_filter
+def scharr(image, *args, out=None):
+    return _edge_image(image, 'scharr', out)
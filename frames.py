@@ -0,0 +1,208 @@
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageSequence, TiffImagePlugin
+
+from batch import IMAGE_EXTENSIONS, collect_inputs, parse_step
+from pointwise import apply_pointwise, is_pointwise
+from registry import apply_filter
+
+# Outputs with one of these extensions are written as a single multi-frame
+# file; anything else is a directory of numbered frames.
+MULTI_FRAME_EXTENSIONS = (".gif", ".tif", ".tiff")
+
+def _frame(image):
+    # A copy in a mode the filters take; the source may seek to the next
+    # frame while this one is still being filtered.
+    frame = image.convert("RGB") if image.mode not in ("L", "RGB") else image.copy()
+    if "duration" in image.info:
+        frame.info["duration"] = image.info["duration"]
+    return frame
+
+def open_frames(source):
+    # Decodes lazily, one frame at a time. source is a multi-frame file such
+    # as a GIF or TIFF, a directory or glob pattern of single images, or a
+    # list of paths.
+    if isinstance(source, (list, tuple)):
+        paths = list(source)
+    elif os.path.isfile(source):
+        paths = None
+    else:
+        paths = collect_inputs([source])
+
+    if paths is None:
+        with Image.open(source) as image:
+            for frame in ImageSequence.Iterator(image):
+                yield _frame(frame)
+    else:
+        for path in paths:
+            with Image.open(path) as image:
+                yield _frame(image)
+
+def prefetch(iterable, depth=4):
+    # Runs iterable on a background thread and keeps up to depth of its
+    # items ready. Errors are raised in the consumer. If the consumer stops
+    # early the producer stops too.
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except BaseException as error:
+            put((False, error))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            more, item = items.get()
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+
+def filter_batch(images, steps, executor=None):
+    # Runs of pointwise steps are applied to the whole batch at once, with
+    # the frames stacked into one tall image: lookups and the grayscale mix
+    # only look at one pixel, so the result equals filtering frame by frame.
+    # Neighbourhood filters would reach into the next frame's rows, so they
+    # run per frame, on the executor when there is one.
+    arrays = [np.asarray(image) for image in images]
+    map_frames = executor.map if executor is not None else map
+    # Frames stay arrays between steps; filters given an array return one.
+    pointwise_steps = []
+    for name, value in list(steps) + [(None, None)]:
+        if name is not None and is_pointwise(name):
+            pointwise_steps.append((name, value))
+            continue
+        if pointwise_steps:
+            if all(array.shape == arrays[0].shape for array in arrays):
+                arrays = np.split(apply_pointwise(np.concatenate(arrays), pointwise_steps), len(arrays))
+            else:
+                arrays = [apply_pointwise(array, pointwise_steps) for array in arrays]
+            pointwise_steps = []
+        if name is not None:
+            arrays = list(map_frames(lambda array: apply_filter(array, name, value), arrays))
+
+    results = []
+    for image, array in zip(images, arrays):
+        result = Image.fromarray(np.ascontiguousarray(array))
+        if "duration" in image.info:
+            result.info["duration"] = image.info["duration"]
+        results.append(result)
+    return results
+
+def filter_frames(frames, steps, batch_size=8, workers=1):
+    # Yields filtered frames in order, holding at most one batch.
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        batch = []
+        for frame in frames:
+            batch.append(frame)
+            if len(batch) == batch_size:
+                yield from filter_batch(batch, steps, executor)
+                batch = []
+        if batch:
+            yield from filter_batch(batch, steps, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+def write_frames(frames, destination, extension=".png"):
+    # Encodes each frame as it arrives and yields the number of frames
+    # written so far. TIFF pages and numbered frame files are written one
+    # at a time. Pillow's GIF encoder pulls the frames itself and keeps a
+    # palettized copy of each until the file is closed, so GIF output grows
+    # with the frame count, at about 1.2 bytes per pixel, and its frames are
+    # only counted once the file is written.
+    if destination.lower().endswith((".tif", ".tiff")):
+        with TiffImagePlugin.AppendingTiffWriter(destination, new=True) as tiff:
+            for count, frame in enumerate(frames, 1):
+                frame.save(tiff, format="TIFF")
+                tiff.newFrame()
+                yield count
+    elif destination.lower().endswith(".gif"):
+        frames = iter(frames)
+        first = next(frames, None)
+        if first is None:
+            return
+        written = 1
+
+        def rest():
+            nonlocal written
+            for frame in frames:
+                written += 1
+                yield frame
+
+        first.save(destination, save_all=True, append_images=rest(), loop=0)
+        yield from range(1, written + 1)
+    else:
+        os.makedirs(destination, exist_ok=True)
+        for count, frame in enumerate(frames, 1):
+            frame.save(os.path.join(destination, f"frame_{count - 1:05d}{extension}"))
+            yield count
+
+def run_pipeline(source, steps, destination, batch_size=8, workers=1, depth=4, extension=".png", progress=None):
+    # Decoding, filtering and encoding run on three threads connected by
+    # bounded queues, so at most a few frames are in memory at any time.
+    # progress is called with the frames written and the seconds elapsed.
+    start = time.perf_counter()
+    count = 0
+    decoded = prefetch(open_frames(source), depth)
+    filtered = prefetch(filter_frames(decoded, steps, batch_size, workers), max(depth, batch_size))
+    for count in write_frames(filtered, destination, extension):
+        if progress is not None:
+            progress(count, time.perf_counter() - start)
+    seconds = time.perf_counter() - start
+    return {"frames": count, "seconds": seconds, "fps": count / seconds if seconds else 0.0}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply filters to every frame of an animation or image sequence.")
+    parser.add_argument("input", help="multi-frame GIF or TIFF, a directory of frames or a glob pattern")
+    parser.add_argument("-f", "--filter", dest="steps", action="append", type=parse_step, required=True,
+                        metavar="NAME[=VALUE]", help="filter to apply, repeat for a chain")
+    parser.add_argument("-o", "--output", required=True,
+                        help="output .gif or .tif file, or a directory for numbered frames")
+    parser.add_argument("--format", default="png", help="frame file extension for directory output (default: png)")
+    parser.add_argument("--batch", type=int, default=8, help="frames filtered together (default: 8)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="threads filtering the frames of a batch side by side (default: 1)")
+    parser.add_argument("--prefetch", type=int, default=4, help="frames decoded ahead (default: 4)")
+    args = parser.parse_args(argv)
+
+    extension = "." + args.format.lstrip(".")
+    if not args.output.lower().endswith(MULTI_FRAME_EXTENSIONS) and extension not in IMAGE_EXTENSIONS:
+        parser.error(f"unsupported frame format {args.format!r}")
+
+    def report(count, seconds):
+        if count % 25 == 0:
+            print(f"{count} frame(s), {count / seconds:.1f} frames/s", end="\r", flush=True)
+
+    summary = run_pipeline(args.input, args.steps, args.output, args.batch, args.workers, args.prefetch,
+                           extension, report)
+    print(f"{summary['frames']} frame(s) in {summary['seconds']:.2f} s: {summary['fps']:.1f} frames/s")
+    return 0 if summary["frames"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
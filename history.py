@@ -0,0 +1,123 @@
+import zlib
+
+import numpy as np
+
+from filters import ImageContext
+from instrument import stage
+from registry import apply_chain, preview_value
+
+class _State():
+    def __init__(self, context, steps):
+        self.steps = tuple(steps)
+        self.shape = context.shape
+        self.original_size = context.original_size
+        self.array = context.array
+        self.compressed = None
+
+    @property
+    def bytes(self):
+        if self.array is not None:
+            return self.array.nbytes
+        return len(self.compressed) if self.compressed is not None else 0
+
+    @property
+    def kept(self):
+        return self.array is not None or self.compressed is not None
+
+    def context(self):
+        if self.array is not None:
+            return ImageContext(self.array, self.original_size)
+        array = np.frombuffer(zlib.decompress(self.compressed), dtype=np.uint8).reshape(self.shape)
+        return ImageContext(array, self.original_size)
+
+class History():
+    # Undo and redo over the states of the preview: the steps applied to the
+    # original so far and the preview they give. The states within
+    # keep_recent of the current one keep their arrays, older ones are
+    # zlib-compressed, and when the snapshots go over max_bytes the ones
+    # farthest from the current state are dropped. A state without a
+    # snapshot is replayed on the preview from the nearest earlier one that
+    # has one; the first state, the uploaded preview, is always kept. With a
+    # cache the replay goes one step at a time, so the previews computed
+    # before each swap are hits.
+    def __init__(self, max_bytes=64 * 2**20, keep_recent=4, level=1, cache=None):
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.keep_recent = keep_recent
+        self.level = level
+        self.states = []
+        self.index = -1
+        self.preview_scale = 1
+
+    def reset(self, context, preview_scale=1):
+        # Steps are stored with their full-size values; replays on the
+        # preview scale them as the preview does.
+        self.states = [_State(context, [])]
+        self.index = 0
+        self.preview_scale = preview_scale
+
+    def push(self, context, steps):
+        # A new state after the current one; anything that could have been
+        # redone is dropped.
+        del self.states[self.index + 1:]
+        self.states.append(_State(context, steps))
+        self.index += 1
+        self.compact()
+
+    @property
+    def can_undo(self):
+        return self.index > 0
+
+    @property
+    def can_redo(self):
+        return self.index < len(self.states) - 1
+
+    @property
+    def bytes(self):
+        return sum(state.bytes for state in self.states)
+
+    def undo(self, count=1):
+        return self.move(max(self.index - count, 0))
+
+    def redo(self, count=1):
+        return self.move(min(self.index + count, len(self.states) - 1))
+
+    def move(self, index):
+        # The context and steps of the state at index, which becomes the
+        # current one and is held uncompressed.
+        if not self.states or index == self.index:
+            return None
+        state = self.states[index]
+        with stage("history", kept=state.kept):
+            context = self.restore(index)
+        state.array, state.compressed = context.array, None
+        self.index = index
+        self.compact()
+        return context, list(state.steps)
+
+    def restore(self, index):
+        state = self.states[index]
+        if state.kept:
+            return state.context()
+        base = max(i for i in range(index) if self.states[i].kept)
+        steps = [(name, preview_value(name, value, self.preview_scale))
+                 for name, value in state.steps[len(self.states[base].steps):]]
+        context = self.restore(base)
+        if self.cache is None:
+            return ImageContext(np.asarray(apply_chain(context, steps)), state.original_size)
+        for step in steps:
+            context = self.cache.apply_chain(context, [step])
+        return ImageContext(np.asarray(context), state.original_size)
+
+    def compact(self):
+        for i, state in enumerate(self.states):
+            if state.array is not None and abs(i - self.index) > self.keep_recent:
+                state.compressed = zlib.compress(state.array, self.level)
+                state.array = None
+        total = self.bytes
+        for i in sorted(range(1, len(self.states)), key=lambda i: abs(i - self.index), reverse=True):
+            if total <= self.max_bytes:
+                break
+            if i != self.index:
+                total -= self.states[i].bytes
+                self.states[i].array = self.states[i].compressed = None
@@ -0,0 +1,150 @@
+import contextlib
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# Off by default. While off, stage() hands back one shared no-op context
+# manager, so an instrumented call costs a function call and a flag check.
+ENABLED = False
+TRACE_VARIABLE = "TRANSFORM_TRACE"
+
+_NULL_STAGE = contextlib.nullcontext()
+_local = threading.local()
+_listeners = []
+_lock = threading.Lock()
+_output = None
+_memory = False
+
+class _Frame():
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.child_seconds = 0.0
+        self.allocated = tracemalloc.get_traced_memory()[0] if _memory else 0
+        self.peak = 0
+
+def enable(path=None, stream=None, memory=True):
+    # Records go to listeners and, as JSON lines, to path or stream. With
+    # memory, allocations are traced too, which slows numpy down a little.
+    # tracemalloc is process-wide, so allocation figures include whatever
+    # other threads do at the same time.
+    global ENABLED, _output, _memory
+    if path is not None:
+        stream = open(path, "a", buffering=1)
+    _output = stream
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    ENABLED = True
+
+def enable_from_environment():
+    # TRANSFORM_TRACE=path appends records to path; "-" writes them to stderr.
+    target = os.environ.get(TRACE_VARIABLE)
+    if target == "-":
+        enable(stream=sys.stderr)
+    elif target:
+        enable(path=target)
+    return ENABLED
+
+def disable():
+    global ENABLED, _output
+    ENABLED = False
+    if _output is not None and _output not in (sys.stdout, sys.stderr):
+        _output.close()
+    _output = None
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def add_listener(callback):
+    # Called with each finished top-level record, on the thread that ran it.
+    _listeners.append(callback)
+
+def remove_listener(callback):
+    _listeners.remove(callback)
+
+def stage(name, **fields):
+    if not ENABLED:
+        return _NULL_STAGE
+    return _stage(name, fields)
+
+def instrumented(name=None):
+    def decorate(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with _stage(stage_name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextlib.contextmanager
+def _stage(name, fields):
+    # Only top-level stages produce records. Nested stages add their own
+    # time (minus their children) and allocations to the top-level record's
+    # breakdown under their path, such as "Median/pad", so a stage entered
+    # once per band shows up as one entry.
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    if _memory and stack:
+        stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+    if _memory:
+        tracemalloc.reset_peak()
+
+    frame = _Frame(name)
+    record = {"stage": name, **fields} if not stack else None
+    if record is not None:
+        frame.stages = {}
+    stack.append(frame)
+    try:
+        yield record
+    finally:
+        stack.pop()
+        seconds = time.perf_counter() - frame.start
+        allocated = 0
+        if _memory:
+            current, peak = tracemalloc.get_traced_memory()
+            allocated = current - frame.allocated
+            frame.peak = max(frame.peak, peak)
+            tracemalloc.reset_peak()
+
+        if stack:
+            stack[-1].child_seconds += seconds
+            stack[-1].peak = max(stack[-1].peak, frame.peak)
+            path = "/".join([parent.name for parent in stack[1:]] + [name])
+            entry = stack[0].stages.setdefault(path, {"seconds": 0.0, "calls": 0, "allocated_bytes": 0})
+            entry["seconds"] += seconds - frame.child_seconds
+            entry["calls"] += 1
+            entry["allocated_bytes"] += allocated
+        else:
+            record.update({
+                "time": time.time(), "thread": threading.current_thread().name,
+                "seconds": seconds, "self_seconds": seconds - frame.child_seconds,
+                "allocated_bytes": allocated, "peak_bytes": frame.peak - frame.allocated if _memory else 0,
+                "stages": frame.stages,
+            })
+            _emit(record)
+
+def _emit(record):
+    if _output is not None:
+        line = json.dumps(record, default=str)
+        with _lock:
+            _output.write(line + "\n")
+    for callback in list(_listeners):
+        callback(record)
+
+def summary(record):
+    # One line for a status bar: total time, then the slowest stages.
+    stages = sorted(record["stages"].items(), key=lambda item: item[1]["seconds"], reverse=True)
+    parts = [f"{name} {entry['seconds'] * 1000:.0f} ms" for name, entry in stages[:5]]
+    text = f"{record['stage']} {record['seconds'] * 1000:.0f} ms"
+    if record.get("peak_bytes"):
+        text += f", peak {record['peak_bytes'] / 2**20:.1f} MB"
+    return text + (": " + ", ".join(parts) if parts else "")
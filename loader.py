@@ -0,0 +1,97 @@
+import functools
+import hashlib
+import os
+
+from PIL import Image, PngImagePlugin
+
+from instrument import stage
+
+# Decoded previews are kept in this directory, or in the one named by
+# PREVIEW_CACHE. Once it holds more than MAX_CACHED_PREVIEWS files the
+# least recently written are removed.
+CACHE_VARIABLE = "PREVIEW_CACHE"
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "image-viewer", "previews")
+MAX_CACHED_PREVIEWS = 500
+
+def cache_directory():
+    return os.environ.get(CACHE_VARIABLE) or DEFAULT_CACHE_DIRECTORY
+
+def cache_path(path, size, directory=None):
+    # The key changes whenever the file is modified or replaced.
+    info = os.stat(path)
+    key = f"{os.path.abspath(path)}\0{info.st_mtime_ns}\0{info.st_size}\0{size[0]}x{size[1]}"
+    name = hashlib.blake2b(key.encode(), digest_size=16).hexdigest() + ".png"
+    return os.path.join(directory or cache_directory(), name)
+
+def decode_preview(path, size):
+    # JPEGs are decoded at 1/2, 1/4 or 1/8 scale straight from the DCT
+    # coefficients, to the smallest scale still at least size, so only the
+    # last factor of two or less is left to resample. reducing_gap lets
+    # other formats shrink by a cheap box reduction before the LANCZOS pass.
+    with Image.open(path) as image:
+        original_size = image.size
+        # The reduced image may cover a fraction of a pixel more than the
+        # original; draft returns the box that corresponds to it.
+        reduced = image.draft(None, size)
+        box = reduced[1] if reduced is not None else None
+        preview = image.resize(size, Image.LANCZOS, box=box, reducing_gap=3.0)
+    return preview, original_size
+
+def _read_cached(cached):
+    try:
+        with Image.open(cached) as image:
+            image.load()
+            width, height = map(int, image.text["original-size"].split("x"))
+            return image.copy(), (width, height)
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _write_cached(cached, preview, original_size):
+    # Written under a temporary name and renamed, so a reader never sees a
+    # partial file. The cache is only an accelerator; failures are ignored.
+    directory = os.path.dirname(cached)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        info = PngImagePlugin.PngInfo()
+        info.add_text("original-size", f"{original_size[0]}x{original_size[1]}")
+        temporary = f"{cached}.{os.getpid()}.tmp"
+        preview.save(temporary, format="PNG", pnginfo=info, compress_level=1)
+        os.replace(temporary, cached)
+        _prune(directory)
+    except OSError:
+        pass
+
+def _prune(directory):
+    entries = [entry for entry in os.scandir(directory) if entry.name.endswith(".png")]
+    if len(entries) > MAX_CACHED_PREVIEWS:
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:len(entries) - MAX_CACHED_PREVIEWS]:
+            os.remove(entry.path)
+
+def load_preview(path, size, use_cache=True):
+    # The preview resized to size and the size of the original. The "decode"
+    # stage records whether it came from the cache.
+    cached = cache_path(path, size) if use_cache else None
+    with stage("decode", path=path) as record:
+        result = _read_cached(cached) if cached is not None and os.path.exists(cached) else None
+        if record is not None:
+            record["cached"] = result is not None
+        if result is None:
+            result = decode_preview(path, size)
+            if cached is not None:
+                _write_cached(cached, *result)
+    return result
+
+@functools.lru_cache(maxsize=1)
+def _load_original(path, mtime_ns):
+    from filters import ImageContext
+    with stage("decode original", path=path):
+        image = Image.open(path)
+        image.load()
+    return ImageContext(image)
+
+def load_original(path):
+    # Full-resolution decode, done only when a full-size render needs it.
+    # The last one is kept as a context, so later renders reuse the decode
+    # and the array and cache key derived from it.
+    return _load_original(path, os.stat(path).st_mtime_ns)
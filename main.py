@@ -1,13 +1,17 @@
+import queue
 import tkinter as tk
 from tkinter import filedialog, StringVar, Scale
 from tkinter import ttk
 from PIL import Image, ImageTk
-import matplotlib.pyplot as plt
-from matplotlib.figure import Figure
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import numpy as np
-from plots import *
-from filters import *
+from registry import FILTERS, PARAMETERS, preview_value
+import instrument
+from instrument import stage, instrumented
+
+PREVIEW_SIZE = (320, 320)
+# Bytes of preview snapshots the undo history may hold.
+HISTORY_BUDGET = 64 * 2**20
+PREVIEW_DELAY = 120
+STATUS_INTERVAL = 250
 
 class App():
     def __init__(self):
@@ -32,37 +36,33 @@ class App():
         self.transform_frame = tk.Frame(self.frame, bg="gray20")
         self.transform_frame.grid(row=0, column=1, padx=10)
         
-        self.transform_options = [
-            "Grayscale", 
-            "Binary",
-            "Brightness", 
-            "Contrast",
-            "Negative",
-            "Binarisation",
-            "Averaging",
-            "Median",
-            "Kuwahara",
-            "Gaussian",
-            "Sharpening",
-            "High Pass",
-            "Ridge",
-            "Roberts",
-            "Prewitt",
-            "Sobel",
-            "Scharr",
-            "Laplace",
-        ]
+        self.transform_options = list(FILTERS)
         self.selected_option = StringVar(self.root)
         self.selected_option.set(self.transform_options[0])
         self.dropdown_menu = tk.OptionMenu(self.transform_frame, self.selected_option, *self.transform_options, command=self.update_slider)
         self.dropdown_menu.grid(row=0, column=0, columnspan=2, sticky="ew", padx=0, pady=10)
         
-        self.slider = ttk.Scale(self.transform_frame, state="disabled", value=1, from_=1, to=10, orient=tk.HORIZONTAL, command=self.update_slider_label)
+        # Kernel for the Convolution filter: rows separated by ';', values
+        # by spaces, fractions such as 1/9 allowed. Enter updates the preview.
+        self.kernel_text = StringVar(self.root, value="0 -1 0; -1 5 -1; 0 -1 0")
+        self.kernel_entry = tk.Entry(self.transform_frame, textvariable=self.kernel_text, width=24, state="disabled")
+        self.kernel_entry.grid(row=0, column=2, padx=(5,0), pady=10)
+        self.kernel_entry.bind("<Return>", lambda event: self.schedule_preview())
+        self.kernel_mode = StringVar(self.root, value="reflect")
+        self.kernel_mode_menu = tk.OptionMenu(self.transform_frame, self.kernel_mode, "reflect", "constant",
+                                              command=lambda mode: self.schedule_preview())
+        self.kernel_mode_menu.grid(row=0, column=3, padx=(5,0), pady=10)
+        self.kernel_mode_menu.config(state="disabled")
+        
+        self.slider = ttk.Scale(self.transform_frame, state="disabled", value=1, from_=1, to=10, orient=tk.HORIZONTAL, command=self.move_slider)
         self.slider.grid(row=1, column=0, sticky="w", padx=0, pady=10)
         
         self.slider_value_label = tk.Label(self.transform_frame, text="0", width=5)
         self.slider_value_label.grid(row=1, column=1, pady=10)
         
+        self.auto_button = tk.Button(self.transform_frame, text="Auto", state="disabled", command=self.auto_parameter)
+        self.auto_button.grid(row=1, column=2, padx=(5,0), pady=10)
+        
         self.transform_button = tk.Button(self.transform_frame, text="Transform Image", command=self.transform_image)
         self.transform_button.config(width=12)
         self.transform_button.grid(row=2, column=0, sticky="w", padx=0, pady=(5,5))
@@ -71,25 +71,92 @@ class App():
         self.swap_button.config(width=12)
         self.swap_button.grid(row=3, column=0, sticky="w", padx=0)
         
+        self.undo_button = tk.Button(self.transform_frame, text="Undo", state="disabled", command=self.undo)
+        self.undo_button.grid(row=3, column=1, sticky="w", padx=(5,0))
+        self.redo_button = tk.Button(self.transform_frame, text="Redo", state="disabled", command=self.redo)
+        self.redo_button.grid(row=3, column=2, sticky="w", padx=(5,0))
+        self.root.bind("<Control-z>", lambda event: self.undo())
+        self.root.bind("<Control-y>", lambda event: self.redo())
+        
+        self.progress_bar = ttk.Progressbar(self.transform_frame, orient=tk.HORIZONTAL, mode="determinate", maximum=100)
+        self.progress_bar.grid(row=4, column=0, columnspan=2, sticky="ew", padx=0, pady=(10,5))
+        
+        self.cancel_button = tk.Button(self.transform_frame, text="Cancel", command=self.cancel_transform)
+        self.cancel_button.config(width=12)
+        self.cancel_button.grid(row=5, column=0, sticky="w", padx=0)
+        
+        self.render_button = tk.Button(self.transform_frame, text="Render Full Size", command=self.render_full_resolution)
+        self.render_button.config(width=12)
+        self.render_button.grid(row=6, column=0, sticky="w", padx=0, pady=(5,0))
+        
+        self.preview_worker = None
+        self.render_worker = None
+        self.plot_panel = None
+        self.history = None
+        self.pending_preview = None
+        self.transformed_step = None
+        
         self.save_button = tk.Button(self.frame, text="Save Image", command=self.save_image)
         self.save_button.grid(row=1, column=2, padx=10, pady=10)
 
         self.plot_frame = tk.Frame(self.frame, bg="gray20")
         self.plot_frame.grid(row=2, column=1, columnspan=2, padx=10, pady=20)
         
+        # Per-stage timings, shown when TRANSFORM_TRACE is set.
+        self.status_bar = tk.Label(self.root, text="", anchor="w", bg="gray15", fg="gray80")
+        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.status_records = queue.SimpleQueue()
+        if instrument.enable_from_environment():
+            instrument.add_listener(self.status_records.put)
+            self.root.after(STATUS_INTERVAL, self.poll_status)
+            
+    def load_modules(self):
+        # numpy, the filters and the workers load once the window is up, and
+        # matplotlib only for the first plot, so nothing heavy delays the
+        # first paint. Calling this again does nothing.
+        if self.preview_worker is None:
+            with stage("load modules"):
+                from worker import TransformWorker
+                from cache import RESULT_CACHE
+                from parallel import default_workers
+                self.preview_worker = TransformWorker(self.root, cache=RESULT_CACHE)
+                # Full-size renders use every core.
+                self.render_worker = TransformWorker(self.root, cache=RESULT_CACHE, workers=default_workers())
+        
+    @instrumented("upload")
     def upload_image(self):
         
         file_path = filedialog.askopenfilename(filetypes=[("PNG Files", "*.png"), ("JPEG Files", "*.jpeg")])
         if file_path:
-            self.image = Image.open(file_path)
-            self.image = self.image.resize((320, 320), Image.LANCZOS)
-            self.image_tk = ImageTk.PhotoImage(self.image)
+            self.load_modules()
+            from cache import RESULT_CACHE
+            from filters import ImageContext
+            from history import History
+            from loader import load_preview
+            self.cancel_transform()
+            # Only the preview is decoded here; the full-size original is
+            # decoded by the first full-size render.
+            self.image, original_size = load_preview(file_path, PREVIEW_SIZE)
+            self.original_path = file_path
+            self.context = ImageContext(self.image, original_size)
+            self.preview_scale = (PREVIEW_SIZE[0] / original_size[0] + PREVIEW_SIZE[1] / original_size[1]) / 2
+            self.steps = []
+            self.transformed_step = None
+            self.history = History(HISTORY_BUDGET, cache=RESULT_CACHE)
+            self.history.reset(self.context, self.preview_scale)
+            self.update_history_buttons()
+            with stage("photo"):
+                self.image_tk = ImageTk.PhotoImage(self.image)
 
             self.image_label_1.destroy()
             self.image_label_1 = tk.Label(self.frame, image=self.image_tk)
             self.image_label_1.grid(row=0, column=0, padx=20)
                                 
-            plot_hist(self.image, self.plot_frame) 
+            with stage("histogram"):
+                if self.plot_panel is None:
+                    from plots import plot_panel
+                    self.plot_panel = plot_panel(self.plot_frame)
+                self.plot_panel.show("Histogram", self.context)
                       
             self.plot_option_frame = tk.Frame(self.frame, bg="gray20")
             self.plot_option_frame.grid(row=2, column=0, padx=(0,20), sticky="e")
@@ -117,12 +184,13 @@ class App():
         if hasattr(self, 'image_tk_transformed'):
             file_path = filedialog.asksaveasfilename(defaultextension=".png", filetypes=[("PNG Files", "*.png"), ("JPEG Files", "*.jpeg")])
             if file_path:
-                self.image_tk_transformed._PhotoImage__photo.write(file_path)
+                self.render_full_resolution(lambda image: image.image.save(file_path))
         else:
             tk.messagebox.showerror("Error", "No transformed image to save.")
                     
     def swap_images(self):
         if hasattr(self, 'image_tk_transformed'):
+            self.cancel_transform()
             img_width, img_height = self.image_tk.width(), self.image_tk.height()
 
             self.image_label_1.destroy()
@@ -131,8 +199,14 @@ class App():
             
             self.image_tk = self.image_tk_transformed
             self.image = self.image_transformed
+            self.context = self.context_transformed
+            self.steps.append(self.transformed_step)
+            self.transformed_step = None
             del self.image_tk_transformed
             del self.image_transformed
+            del self.context_transformed
+            self.history.push(self.context, self.steps)
+            self.update_history_buttons()
             
             self.image_label_2.destroy()
             self.image_label_2 = tk.Label(self.frame, text="Transfrom image", width=35, height=20, bg="gray")
@@ -141,123 +215,189 @@ class App():
             self.dropdown_menu_image.config(state="normal")
         else:
             tk.messagebox.showerror("Error", "No transformed image to swap.")
-                
-    def update_slider_label(self, value):
-        self.slider_value_label.config(text=str(int(float(value))))
-        
-    def update_slider(self, value):
-        if value == "Grayscale":
-            self.slider.config(state="disabled")
-            
-        elif value == "Binary":
-            self.slider.config(state="normal", value=100, from_=0, to=255)
 
-        elif value == "Brightness":
-            self.slider.config(state="normal", value=0, from_=-255, to=255)
+    def undo(self):
+        if self.history is not None and self.history.can_undo:
+            self.restore_state(self.history.undo())
 
-        elif value == "Contrast":
-            self.slider.config(state="normal", value=1, from_=0.1, to=4)
+    def redo(self):
+        if self.history is not None and self.history.can_redo:
+            self.restore_state(self.history.redo())
 
-        elif value == "Negative":
-            self.slider.config(state="disabled")
-
-        elif value == "Binarisation":
-            self.slider.config(state="normal", value=0, from_=0, to=255)
-
-        elif value == "Averaging":
-            self.slider.config(state="normal", value=1, from_=1, to=10)
-
-        elif value == "Median":
-            self.slider.config(state="normal", value=1, from_=1, to=10)
-
-        elif value == "Gaussian":
-            self.slider.config(state="normal", value=1, from_=0.1, to=5)
+    def restore_state(self, state):
+        # Puts a swapped-in state from the history back as the original and
+        # discards the transformed image.
+        self.cancel_transform()
+        self.context, self.steps = state
+        self.image = self.context.image
+        self.transformed_step = None
+        with stage("photo"):
+            self.image_tk = ImageTk.PhotoImage(self.image)
 
-        elif value == "Sharpening":
-            self.slider.config(state="normal", value=1, from_=1, to=20)
+        self.image_label_1.destroy()
+        self.image_label_1 = tk.Label(self.frame, image=self.image_tk)
+        self.image_label_1.grid(row=0, column=0, padx=20)
 
-        elif value == "Roberts":
-            self.slider.config(state="disabled")
+        if hasattr(self, 'image_tk_transformed'):
+            del self.image_tk_transformed
+            del self.image_transformed
+            del self.context_transformed
+            self.image_label_2.destroy()
+            self.image_label_2 = tk.Label(self.frame, text="Transfrom image", width=35, height=20, bg="gray")
+            self.image_label_2.grid(row=0, column=2, padx=10)
+        self.update_history_buttons()
 
-        elif value == "Sobel":
-            self.slider.config(state="disabled")
+    def update_history_buttons(self):
+        self.undo_button.config(state="normal" if self.history.can_undo else "disabled")
+        self.redo_button.config(state="normal" if self.history.can_redo else "disabled")
 
-        elif value == "High Pass":
-            self.slider.config(state="normal", value=10, from_=4, to=20)
+    def update_slider_label(self, value):
+        self.slider_value_label.config(text=str(int(float(value))))
         
-        elif value == "Laplace":
-            self.slider.config(state="disabled")
-            
-        elif value == "Prewitt":
-            self.slider.config(state="disabled")
-
-        elif value == "Kuwahara":
-            self.slider.config(state="normal", value=1, from_=1, to=10)
-            
-        elif value == "Ridge":
-            self.slider.config(state="disabled")
-            
-        elif value == "Scharr":
+    def update_slider(self, value):
+        if PARAMETERS[value] is None:
             self.slider.config(state="disabled")
+        else:
+            default, minimum, maximum = PARAMETERS[value]
+            self.slider.config(state="normal", value=default, from_=minimum, to=maximum)
+        from stats import AUTO_VALUES
+        self.auto_button.config(state="normal" if value in AUTO_VALUES else "disabled")
+        self.kernel_entry.config(state="normal" if value == "Convolution" else "disabled")
+        self.kernel_mode_menu.config(state="normal" if value == "Convolution" else "disabled")
         
         self.update_slider_label(self.slider.get())
+        self.schedule_preview()
+        
+    def auto_parameter(self):
+        # Picks the parameter from the preview's statistics, such as an Otsu
+        # threshold for Binary and Binarisation.
+        if hasattr(self, 'context'):
+            from stats import auto_value
+            self.slider.set(auto_value(self.selected_option.get(), self.context))
+            self.move_slider(self.slider.get())
+        else:
+            tk.messagebox.showerror("Error", "No image to transfrom.")
+        
+    def move_slider(self, value):
+        self.update_slider_label(value)
+        self.schedule_preview()
+        
+    def schedule_preview(self):
+        # Coalesce rapid slider drags into one preview run.
+        if hasattr(self, 'image_tk'):
+            if self.pending_preview is not None:
+                self.root.after_cancel(self.pending_preview)
+            self.pending_preview = self.root.after(PREVIEW_DELAY, self.transform_image)
             
     def transform_image(self):
         if hasattr(self, 'image_tk'):
+            if self.pending_preview is not None:
+                self.root.after_cancel(self.pending_preview)
+                self.pending_preview = None
             selected_option = self.selected_option.get()
-            slider_value = self.slider.get()
+            try:
+                value = self.step_value(selected_option)
+            except ValueError as error:
+                tk.messagebox.showerror("Error", f"Invalid kernel: {error}")
+                return
+            # The step becomes the transformed one when its preview is shown,
+            # so Swap and Save never use a step whose result was not seen.
+            step = (selected_option, value)
+            preview_step = (selected_option, preview_value(selected_option, value, self.preview_scale))
+            self.preview_worker.submit(self.context, [preview_step],
+                                       lambda image: self.show_transformed_image(image, step),
+                                       on_error=self.show_transform_error)
+        else:
+            tk.messagebox.showerror("Error", "No image to transfrom.")
             
-            filters = {
-                "Grayscale": grayscale,
-                "Binary": binary,
-                "Brightness": brightness_correction,
-                "Contrast": contrast_correction,
-                "Negative": negative_filter,
-                "Binarisation": binarisation,
-                "Averaging": averaging,
-                "Median": median,
-                "Kuwahara": kuwahara,
-                "Ridge": ridge,
-                "Gaussian": gaussian,
-                "Sharpening": sharpening,
-                "Roberts": roberts,
-                "Sobel": sobel,
-                "High Pass": high_pass,
-                "Laplace": laplace,
-                "Prewitt": prewitt,
-                "Scharr": scharr, 
-            }
+    def step_value(self, name):
+        # The slider value, or for Convolution the kernel and padding mode.
+        if name == "Convolution":
+            from convolution import parse_kernel
+            return parse_kernel(self.kernel_text.get()), self.kernel_mode.get()
+        return self.slider.get()
             
-            self.image_transformed = filters[selected_option](self.image, slider_value)
+    def render_full_resolution(self, on_done=None):
+        if self.transformed_step is None:
+            tk.messagebox.showerror("Error", "No transformed image to render.")
+            return
+        
+        # The result cache lets this continue from the last full-size render
+        # of the swapped-in steps.
+        step = self.transformed_step
+        steps = self.steps + [step]
+        
+        def finish(image):
+            self.show_transformed_image(image, step)
+            if on_done is not None:
+                on_done(image)
+        
+        from loader import load_original
+        path = self.original_path
+        self.progress_bar.config(value=0)
+        self.render_worker.submit(lambda: load_original(path), steps, finish, on_progress=self.update_progress,
+                                  on_error=self.show_transform_error)
             
-            self.image_transformed = self.image_transformed.resize((320, 320), Image.LANCZOS)
+    @instrumented("show")
+    def show_transformed_image(self, image, step):
+        # image is a context, the result of step on the original. Previews
+        # are already the right size and go to Tk without resampling;
+        # full-size renders are resized for display.
+        if image.size == PREVIEW_SIZE:
+            self.context_transformed = image
+        else:
+            from filters import ImageContext
+            with stage("resize"):
+                resized = image.image.resize(PREVIEW_SIZE, Image.LANCZOS)
+            self.context_transformed = ImageContext(resized, image.original_size)
+        self.image_transformed = self.context_transformed.image
+        self.transformed_step = step
+        with stage("photo"):
             self.image_tk_transformed = ImageTk.PhotoImage(self.image_transformed)
 
-            self.image_label_2.destroy()
-            self.image_label_2 = tk.Label(self.frame, image=self.image_tk_transformed)
-            self.image_label_2.grid(row=0, column=2, padx=20)
-            
-            self.dropdown_menu_image.config(state="normal")
-        else:
-            tk.messagebox.showerror("Error", "No image to transfrom.")
+        self.image_label_2.destroy()
+        self.image_label_2 = tk.Label(self.frame, image=self.image_tk_transformed)
+        self.image_label_2.grid(row=0, column=2, padx=20)
+        
+        self.dropdown_menu_image.config(state="normal")
+        
+    def update_progress(self, fraction):
+        self.progress_bar.config(value=fraction * 100)
+        
+    def cancel_transform(self):
+        self.preview_worker.cancel()
+        self.render_worker.cancel()
+        self.progress_bar.config(value=0)
         
+    def show_transform_error(self, error):
+        self.progress_bar.config(value=0)
+        tk.messagebox.showerror("Error", f"Transform failed: {error}")
+        
+    def poll_status(self):
+        # The two latest records, so a transform stays visible next to the
+        # display update that follows it.
+        records = []
+        while not self.status_records.empty():
+            records = (records + [self.status_records.get()])[-2:]
+        if records:
+            self.status_bar.config(text="  |  ".join(instrument.summary(record) for record in reversed(records)))
+        self.root.after(STATUS_INTERVAL, self.poll_status)
+        
+    @instrumented("plot")
     def plot(self):
         selected_plot = self.selected_plot.get() 
         if hasattr(self, 'selected_image'):
             selected_image = self.selected_image.get()
         else:
             selected_image = "Original"        
-        image = self.image if selected_image == "Original" else self.image_transformed
-        
-        
-        if selected_plot == "Histogram":
-            plot_hist(image, self.plot_frame)
-        elif selected_plot == "Horizontal Projection":
-            plot_horizontal_projection(image, self.plot_frame)
-        elif selected_plot == "Vertical Projection":
-            plot_vertical_projection(image, self.plot_frame)
+        image = self.context if selected_image == "Original" else self.context_transformed
+        self.plot_panel.show(selected_plot, image)
         
     def run(self):
+        # Paint the window before loading the rest.
+        self.root.update()
+        self.load_modules()
         self.root.mainloop()
         
-App().run()
\ No newline at end of file
+if __name__ == "__main__":
+    App().run()
@@ -0,0 +1,119 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import filters
+from filters import ImageContext, image_context
+from registry import apply_chain
+from tiling import chain_radius, chain_working_bytes
+
+# More strips than workers, so a slow strip does not leave the other workers
+# idle at the end of a run.
+STRIPS_PER_WORKER = 4
+
+def default_workers():
+    return os.cpu_count() or 1
+
+def strip_count(shape, workers, memory_budget=None, steps=()):
+    count = workers * STRIPS_PER_WORKER
+    if memory_budget:
+        # Every worker holds one strip's temporaries at a time, halo
+        # included. Strips are not made thinner than the halo, where the
+        # halo would be most of the work; a budget that needs thinner strips
+        # is exceeded.
+        halo = chain_radius(steps)
+        def fits(count):
+            strip = (-(-shape[0] // count) + 2 * halo,) + tuple(shape[1:])
+            return chain_working_bytes(steps, strip) * workers <= memory_budget
+        while count < shape[0] and -(-shape[0] // count) > halo and not fits(count):
+            count = max(count + 1, count * 5 // 4)
+    return max(1, min(count, shape[0]))
+
+def iter_strips(rows, count):
+    step = -(-rows // count)
+    for top in range(0, rows, step):
+        yield top, min(top + step, rows)
+
+def output_shape(source, steps):
+    # Channels of the result, from running the chain on a corner of the
+    # image; grayscale and edge filters turn colour into one channel.
+    corner = ImageContext(source[:8, :8])
+    return source.shape[:2] + np.asarray(apply_chain(corner, steps)).shape[2:]
+
+def process_strip(source, output, steps, top, bottom, halo):
+    # As in tiling, the halo holds real neighbours inside the image and the
+    # filters pad at its border as they would for the whole image, so the
+    # strip matches the same rows of a serial run.
+    region_top = max(top - halo, 0)
+    region = ImageContext(source[region_top:min(bottom + halo, source.shape[0])])
+    result = np.asarray(apply_chain(region, steps))
+    output[top:bottom] = result[top - region_top:bottom - region_top]
+
+def _attach(name, shape):
+    memory = shared_memory.SharedMemory(name=name)
+    return memory, np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+
+def _init_process(compact):
+    filters.COMPACT = compact
+
+def _process_shared_strip(source_name, source_shape, output_name, output_shape, steps, top, bottom, halo):
+    source_memory, source = _attach(source_name, source_shape)
+    output_memory, output = _attach(output_name, output_shape)
+    try:
+        process_strip(source, output, steps, top, bottom, halo)
+    finally:
+        del source, output
+        source_memory.close()
+        output_memory.close()
+
+def _run_strips(executor, submit, strips, progress):
+    futures = [submit(top, bottom) for top, bottom in strips]
+    try:
+        for done, future in enumerate(as_completed(futures), 1):
+            future.result()
+            if progress is not None:
+                progress(done, len(futures))
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+def process_parallel(image, steps, workers=None, processes=False, memory_budget=None, progress=None):
+    # Splits the image into horizontal strips, each read with a halo as wide
+    # as the chain's combined kernel radius, and runs the chain on the strips
+    # concurrently. Threads share the arrays directly and rely on numpy
+    # releasing the GIL; processes attach to shared-memory copies of the
+    # source and output. Either way the result is bit-identical to a serial
+    # run, except for Recursive Gaussian as described in filter_radius.
+    # progress may raise to stop the run; strips not yet started are
+    # dropped.
+    workers = workers or default_workers()
+    source = image_context(image).array
+    halo = chain_radius(steps)
+    shape = output_shape(source, steps)
+    strips = list(iter_strips(source.shape[0], strip_count(source.shape, workers, memory_budget, steps)))
+
+    if not processes:
+        output = np.empty(shape, dtype=np.uint8)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            _run_strips(executor, lambda top, bottom: executor.submit(
+                process_strip, source, output, steps, top, bottom, halo), strips, progress)
+        return output
+
+    source_memory = shared_memory.SharedMemory(create=True, size=max(source.nbytes, 1))
+    output_memory = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)), 1))
+    try:
+        np.ndarray(source.shape, dtype=np.uint8, buffer=source_memory.buf)[...] = source
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_process,
+                                 initargs=(filters.COMPACT,)) as executor:
+            _run_strips(executor, lambda top, bottom: executor.submit(
+                _process_shared_strip, source_memory.name, source.shape, output_memory.name, shape,
+                steps, top, bottom, halo), strips, progress)
+        return np.ndarray(shape, dtype=np.uint8, buffer=output_memory.buf).copy()
+    finally:
+        source_memory.close()
+        source_memory.unlink()
+        output_memory.close()
+        output_memory.unlink()
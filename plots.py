@@ -1,104 +1,137 @@
 import numpy as np
-import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import tkinter as tk
 
+from stats import statistics
+
+PLOT_KINDS = ("Histogram", "Horizontal Projection", "Vertical Projection")
+CHANNEL_COLORS = ("red", "green", "blue")
+HISTOGRAM_BINS = 128
+
+class PlotPanel():
+    # One figure and canvas for the lifetime of the plot frame, with an axes
+    # per plot kind stacked in the same place. Showing a plot sets the data
+    # of the existing artists. The artists are animated, so once a kind has
+    # been drawn at the current canvas size its background is kept and only
+    # the artists are redrawn over it and blitted.
+    def __init__(self, plot_frame):
+        self.figure = Figure(figsize=(5, 4), dpi=100)
+        self.canvas = FigureCanvasTkAgg(self.figure, master=plot_frame)
+        self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+        self.canvas.mpl_connect("draw_event", self.on_draw)
+        self.backgrounds = {}
+        self.kind = None
+
+        self.axes = {}
+        self.artists = {}
+        edges = np.linspace(0, 256, HISTOGRAM_BINS + 1)
+        for kind in PLOT_KINDS:
+            ax = self.figure.add_subplot(111, label=kind)
+            ax.set_title(kind)
+            ax.set_xticks([])
+            ax.set_yticks([])
+            ax.set_visible(False)
+            artists = {}
+            for color in CHANNEL_COLORS + ("gray",):
+                if kind == "Histogram":
+                    artists[color] = ax.stairs(np.zeros(HISTOGRAM_BINS), edges, fill=True,
+                                               color=color, alpha=0.5, animated=True)
+                else:
+                    artists[color], = ax.plot([], [], color=color, linewidth=2, animated=True)
+            if kind == "Histogram":
+                ax.set_xlim(0, 255)
+            self.axes[kind] = ax
+            self.artists[kind] = artists
+
+    def show(self, kind, image):
+        # image may be an ImageContext, which keeps its statistics.
+        image_statistics = statistics(image)
+        colors = CHANNEL_COLORS if image_statistics.channels >= 3 else ("gray",)
+        ax = self.axes[kind]
+
+        if kind == "Histogram":
+            self.set_histogram(image_statistics, colors)
+        else:
+            self.set_projection(kind, image_statistics, colors)
+        for color, artist in self.artists[kind].items():
+            artist.set_visible(color in colors)
+
+        if kind != self.kind:
+            for other in self.axes.values():
+                other.set_visible(other is ax)
+            self.kind = kind
+        if self.background_key() in self.backgrounds:
+            self.blit()
+        else:
+            self.canvas.draw()
+
+    def set_histogram(self, image_statistics, colors):
+        top = 1
+        for color, histogram in zip(colors, image_statistics.histograms):
+            counts = histogram.reshape(HISTOGRAM_BINS, -1).sum(axis=1)
+            self.artists["Histogram"][color].set_data(counts)
+            top = max(top, counts.max())
+        # Limits are set from the data directly; relim() on step patches is
+        # slower than everything else here put together.
+        self.axes["Histogram"].set_ylim(0, top * 1.05)
+
+    def set_projection(self, kind, image_statistics, colors):
+        axis = 0 if kind == "Horizontal Projection" else 1
+        projection = image_statistics.projection(axis)
+        peaks = projection.max(axis=0)
+        projection = projection / np.where(peaks > 0, peaks, 1)
+        positions = np.arange(len(projection))
+        for index, color in enumerate(colors):
+            if axis == 0:
+                self.artists[kind][color].set_data(positions, projection[:, index])
+            else:
+                self.artists[kind][color].set_data(projection[:, index], positions)
+
+        low = projection[:, :len(colors)].min()
+        value_limits = (low - (1 - low) * 0.05, 1 + (1 - low) * 0.05)
+        position_limits = (-0.05 * len(positions), 1.05 * len(positions))
+        ax = self.axes[kind]
+        if axis == 0:
+            ax.set_xlim(*position_limits)
+            ax.set_ylim(*value_limits)
+        else:
+            ax.set_xlim(*value_limits)
+            ax.set_ylim(*position_limits[::-1])
+
+    def background_key(self):
+        return self.kind, tuple(self.figure.bbox.bounds)
+
+    def on_draw(self, event):
+        # Any full draw, including after a resize, refreshes the background.
+        if self.kind is None:
+            return
+        self.backgrounds[self.background_key()] = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.draw_artists()
+
+    def blit(self):
+        self.canvas.restore_region(self.backgrounds[self.background_key()])
+        self.draw_artists()
+        self.canvas.blit(self.figure.bbox)
+
+    def draw_artists(self):
+        ax = self.axes[self.kind]
+        for artist in self.artists[self.kind].values():
+            if artist.get_visible():
+                ax.draw_artist(artist)
+
+_panels = {}
+
+def plot_panel(plot_frame):
+    if plot_frame not in _panels:
+        _panels[plot_frame] = PlotPanel(plot_frame)
+    return _panels[plot_frame]
+
 def plot_hist(image, plot_frame):
-    fig = Figure(figsize=(5, 4), dpi=100)
-    ax = fig.add_subplot(111)
-    
-    if image:
-        image_array = np.array(image)
-        
-        if image_array.ndim == 3: 
-            r, g, b = image_array[:, :, 0], image_array[:, :, 1], image_array[:, :, 2]
-
-            ax.hist(r.ravel(), bins=128, color='red', alpha=0.5, label='Red')
-            ax.hist(g.ravel(), bins=128, color='green', alpha=0.5, label='Green')
-            ax.hist(b.ravel(), bins=128, color='blue', alpha=0.5, label='Blue')
-        else:  
-            ax.hist(image_array.ravel(), bins=128, color='gray', alpha=0.5, label='Gray')
-
-        ax.set_title("Histogram")
-        ax.set_xticks([])
-        ax.set_yticks([])
-        ax.set_xlim(0, 255)
-
-        for widget in plot_frame.winfo_children():
-            widget.destroy()
-
-    canvas = FigureCanvasTkAgg(fig, master=plot_frame)
-    canvas.draw()
-    canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+    plot_panel(plot_frame).show("Histogram", image)
 
 def plot_vertical_projection(image, plot_frame):
-    fig = Figure(figsize=(5, 4), dpi=100)
-    ax = fig.add_subplot(111)
-
-    if image:
-        image_array = np.array(image)
-        
-        if image_array.ndim == 3: 
-            vertical_projection_red = np.sum(image_array[:, :, 0], axis=1)
-            vertical_projection_green = np.sum(image_array[:, :, 1], axis=1)
-            vertical_projection_blue = np.sum(image_array[:, :, 2], axis=1)
-
-            vertical_projection_red = vertical_projection_red / vertical_projection_red.max()
-            vertical_projection_green = vertical_projection_green / vertical_projection_green.max()
-            vertical_projection_blue = vertical_projection_blue / vertical_projection_blue.max()
-
-            ax.plot(vertical_projection_red, range(len(vertical_projection_red)), color="red", linewidth=2, label='Red')
-            ax.plot(vertical_projection_green, range(len(vertical_projection_green)), color="green", linewidth=2, label='Green')
-            ax.plot(vertical_projection_blue, range(len(vertical_projection_blue)), color="blue", linewidth=2, label='Blue')
-        else: 
-            vertical_projection_gray = np.sum(image_array, axis=1)
-            vertical_projection_gray = vertical_projection_gray / vertical_projection_gray.max()
-            ax.plot(vertical_projection_gray, range(len(vertical_projection_gray)), color="gray", linewidth=2, label='Gray')
-
-        ax.invert_yaxis()
-        ax.set_xticks([])
-        ax.set_yticks([])
-        ax.set_title("Vertical Projection")
-
-        for widget in plot_frame.winfo_children():
-            widget.destroy()
-
-    canvas = FigureCanvasTkAgg(fig, master=plot_frame)
-    canvas.draw()
-    canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
-    
+    plot_panel(plot_frame).show("Vertical Projection", image)
+
 def plot_horizontal_projection(image, plot_frame):
-    fig = Figure(figsize=(5, 4), dpi=100)
-    ax = fig.add_subplot(111)
-
-    if image:
-        image_array = np.array(image)
-        
-        if image_array.ndim == 3: 
-            horizontal_projection_red = np.sum(image_array[:, :, 0], axis=0)
-            horizontal_projection_green = np.sum(image_array[:, :, 1], axis=0)
-            horizontal_projection_blue = np.sum(image_array[:, :, 2], axis=0)
-
-            horizontal_projection_red = horizontal_projection_red / horizontal_projection_red.max()
-            horizontal_projection_green = horizontal_projection_green / horizontal_projection_green.max()
-            horizontal_projection_blue = horizontal_projection_blue / horizontal_projection_blue.max()
-
-            ax.plot(range(len(horizontal_projection_red)), horizontal_projection_red, color="red", linewidth=2, label='Red')
-            ax.plot(range(len(horizontal_projection_green)), horizontal_projection_green, color="green", linewidth=2, label='Green')
-            ax.plot(range(len(horizontal_projection_blue)), horizontal_projection_blue, color="blue", linewidth=2, label='Blue')
-        else: 
-            horizontal_projection_gray = np.sum(image_array, axis=0)
-            horizontal_projection_gray = horizontal_projection_gray / horizontal_projection_gray.max()
-            ax.plot(range(len(horizontal_projection_gray)), horizontal_projection_gray, color="gray", linewidth=2, label='Gray')
-
-        ax.set_xticks([])
-        ax.set_yticks([])
-        ax.set_title("Horizontal Projection")
-
-        for widget in plot_frame.winfo_children():
-            widget.destroy()
-
-    canvas = FigureCanvasTkAgg(fig, master=plot_frame)
-    canvas.draw()
-    canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
\ No newline at end of file
+    plot_panel(plot_frame).show("Horizontal Projection", image)
@@ -0,0 +1,54 @@
+
+from instrument import instrumented
+from filters import grayscale, image_context, image_filter, brightness_lut, contrast_lut, negative_lut, threshold_lut
+
+POINTWISE_FILTERS = {
+    "Brightness": brightness_lut,
+    "Contrast": contrast_lut,
+    "Negative": negative_lut,
+    "Binarisation": threshold_lut,
+}
+
+# Grayscale mixes channels, so on colour images it splits a chain into
+# separate lookup tables. Binary is grayscale followed by a threshold.
+CHANNEL_MIXING_FILTERS = ("Grayscale", "Binary")
+
+def is_pointwise(name):
+    return name in POINTWISE_FILTERS or name in CHANNEL_MIXING_FILTERS
+
+def compile_pointwise(steps, grayscale_input=False):
+    stages = []
+    lut = None
+    single_channel = grayscale_input
+
+    for name, value in steps:
+        if name in CHANNEL_MIXING_FILTERS:
+            if not single_channel:
+                if lut is not None:
+                    stages.append(lut)
+                stages.append(None)
+                lut = None
+                single_channel = True
+            if name != "Binary":
+                continue
+            step_lut = threshold_lut(value)
+        else:
+            step_lut = POINTWISE_FILTERS[name](value)
+        lut = step_lut if lut is None else step_lut[lut]
+
+    if lut is not None:
+        stages.append(lut)
+    return stages
+
+@instrumented("Pointwise")
+@image_filter
+def apply_pointwise(image, steps):
+    image_array = image_context(image).array
+
+    for stage in compile_pointwise(steps, grayscale_input=image_array.ndim == 2):
+        if stage is None:
+            image_array = grayscale(image_array)
+        else:
+            image_array = stage[image_array]
+
+    return image_array
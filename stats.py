@@ -0,0 +1,118 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from cache import content_key
+from filters import ImageContext, image_context, _bands
+
+class ImageStatistics():
+    # Per-channel 256-bin histograms and row and column sums of a uint8
+    # image, gathered in one banded pass. Everything else is derived from
+    # the histograms without going back to the pixels.
+    def __init__(self, image_array):
+        image_array = np.asarray(image_array)
+        rows, cols = image_array.shape[:2]
+        channels = image_array.shape[2] if image_array.ndim == 3 else 1
+        image_array = image_array.reshape(rows, cols, channels)
+
+        self.histograms = np.zeros((channels, 256), dtype=np.int64)
+        self.row_sums = np.empty((rows, channels), dtype=np.int64)
+        self.column_sums = np.zeros((cols, channels), dtype=np.int64)
+        for top, bottom in _bands(rows, cols):
+            # Reducing one channel at a time is several times faster than
+            # summing the interleaved band over its middle axis.
+            for channel in range(channels):
+                plane = image_array[top:bottom, :, channel]
+                self.histograms[channel] += np.bincount(plane.ravel(), minlength=256)
+                self.row_sums[top:bottom, channel] = plane.sum(axis=1, dtype=np.int64)
+                self.column_sums[:, channel] += plane.sum(axis=0, dtype=np.int64)
+
+        self.pixels = rows * cols
+        self.shape = image_array.shape
+
+    @property
+    def channels(self):
+        return self.histograms.shape[0]
+
+    @property
+    def minimum(self):
+        return np.argmax(self.histograms > 0, axis=1)
+
+    @property
+    def maximum(self):
+        return 255 - np.argmax(self.histograms[:, ::-1] > 0, axis=1)
+
+    @property
+    def mean(self):
+        return self.histograms @ np.arange(256) / max(self.pixels, 1)
+
+    @property
+    def std(self):
+        deviations = np.arange(256) - self.mean[:, None]
+        return np.sqrt((self.histograms * deviations**2).sum(axis=1) / max(self.pixels, 1))
+
+    def percentile(self, q):
+        # The lowest level whose cumulative count reaches q percent of the
+        # pixels, as np.percentile(..., method='inverted_cdf') gives.
+        counts = np.cumsum(self.histograms, axis=1)
+        ranks = np.maximum(np.ceil(np.asarray(q, dtype=float) / 100 * self.pixels), 1)
+        return np.array([np.searchsorted(counts[channel], ranks) for channel in range(self.channels)])
+
+    def projection(self, axis):
+        # Sums along axis 0 give one value per column, along axis 1 one per row.
+        return self.column_sums if axis == 0 else self.row_sums
+
+    def otsu_threshold(self):
+        # The threshold t maximising the between-class variance of levels
+        # <= t against levels > t, over all channels together, which suits
+        # the level > t test of the threshold filters.
+        histogram = self.histograms.sum(axis=0).astype(float)
+        weights = np.cumsum(histogram)
+        sums = np.cumsum(histogram * np.arange(256))
+        total, total_sum = weights[-1], sums[-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            between = (total_sum * weights - total * sums) ** 2 / (weights * (total - weights))
+        between[~np.isfinite(between)] = -1
+        return int(np.argmax(between))
+
+class _StatisticsCache():
+    # Statistics of plain images, keyed by content so a copy of the same
+    # image is a hit. Contexts keep their own statistics.
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, image, compute):
+        key = content_key(image)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        result = compute()
+        with self.lock:
+            self.entries[key] = result
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return result
+
+_cache = _StatisticsCache()
+
+def statistics(image):
+    if isinstance(image, ImageContext):
+        return image.memo('statistics', lambda: ImageStatistics(image.array))
+    return _cache.get(image, lambda: ImageStatistics(image_context(image).array))
+
+def otsu_threshold(image):
+    return statistics(image).otsu_threshold()
+
+# Filters whose parameter can be chosen from the image. Binary thresholds
+# the grayscale version, Binarisation every channel with one threshold.
+AUTO_VALUES = {
+    "Binary": lambda image: otsu_threshold(image_context(image).grayscale()),
+    "Binarisation": otsu_threshold,
+}
+
+def auto_value(name, image):
+    return AUTO_VALUES[name](image)
@@ -0,0 +1,299 @@
+import unittest
+from fractions import Fraction
+
+import numpy as np
+from PIL import Image
+
+import convolution
+import filters
+
+# The filters as they were first written, one window and one channel at a
+# time in float64. Every rewrite of a filter must give the same uint8 output,
+# except where noted: Kuwahara breaks exact ties between quadrants
+# differently, see test_kuwahara_ties.
+
+def _reference_grayscale(image_array):
+    if image_array.ndim == 2:
+        return image_array
+    grayscale = np.dot(image_array[..., :3].astype(float), [0.2989, 0.5870, 0.1140])
+    return np.clip(grayscale, 0, 255).astype(np.uint8)
+
+def _reference_windows(image_array, size, mode, reduce):
+    # reduce(region) for every size x size window of every channel.
+    image_array = image_array.astype(float)
+    offset = size // 2
+    planes = image_array[..., None] if image_array.ndim == 2 else image_array
+    pad_width = ((offset, offset), (offset, offset), (0, 0))
+    if mode == 'constant':
+        padded = np.pad(planes, pad_width, mode='constant', constant_values=0)
+    else:
+        padded = np.pad(planes, pad_width, mode=mode)
+    result = np.zeros_like(planes)
+    for i in range(planes.shape[0]):
+        for j in range(planes.shape[1]):
+            for k in range(planes.shape[2]):
+                result[i, j, k] = reduce(padded[i:i+size, j:j+size, k])
+    return result.reshape(image_array.shape)
+
+def _uint8(values):
+    return np.clip(values, 0, 255).astype(np.uint8)
+
+def _reference_kernel(image_array, kernel, mode):
+    return _uint8(_reference_sums(image_array, kernel, mode))
+
+def _reference_sums(image_array, kernel, mode):
+    return _reference_windows(image_array, len(kernel), mode, lambda region: np.sum(region * kernel))
+
+def _reference_gradient(image_array, kernel_x, kernel_y, mode):
+    image_array = _reference_grayscale(image_array)
+    size = len(kernel_x)
+    gx = _reference_windows(image_array, size, mode, lambda region: np.sum(region[:size, :size] * kernel_x))
+    gy = _reference_windows(image_array, size, mode, lambda region: np.sum(region[:size, :size] * kernel_y))
+    return _uint8(np.sqrt(gx**2 + gy**2))
+
+def _reference_roberts(image_array):
+    # A 2x2 kernel on an image padded by one on every side.
+    image_array = _reference_grayscale(image_array).astype(float)
+    padded = np.pad(image_array, 1, mode='constant', constant_values=0)
+    edges = np.zeros_like(image_array)
+    for i in range(image_array.shape[0]):
+        for j in range(image_array.shape[1]):
+            gx = np.sum(padded[i:i+2, j:j+2] * np.array([[1, 0], [0, -1]]))
+            gy = np.sum(padded[i:i+2, j:j+2] * np.array([[0, 1], [-1, 0]]))
+            edges[i, j] = np.sqrt(gx**2 + gy**2)
+    return _uint8(edges)
+
+def _gaussian_kernel(sigma):
+    size = int(6 * sigma) | 1
+    ax = np.linspace(-(size // 2), size // 2, size)
+    kernel = np.exp(-0.5 * (ax / sigma) ** 2)
+    kernel = np.outer(kernel, kernel)
+    return kernel / np.sum(kernel)
+
+def _averaging_kernel(kernel_size):
+    kernel_size = int(kernel_size)
+    return np.ones((kernel_size, kernel_size)) / (kernel_size * kernel_size)
+
+def _reference_kuwahara(image_array, kernel_size, variance=np.var):
+    offset = kernel_size // 2
+
+    def reduce(region):
+        regions = [region[:offset+1, :offset+1], region[:offset+1, offset:],
+                   region[offset:, :offset+1], region[offset:, offset:]]
+        return [np.mean(r) for r in regions][np.argmin([variance(r) for r in regions])]
+
+    return _uint8(_reference_windows(image_array, 2 * offset + 1, 'reflect', reduce)
+                  if kernel_size % 2 else _reference_even_kuwahara(image_array, kernel_size, variance))
+
+def _reference_even_kuwahara(image_array, kernel_size, variance=np.var):
+    offset = kernel_size // 2
+    planes = image_array[..., None] if image_array.ndim == 2 else image_array
+    padded = np.pad(planes.astype(float), ((offset, offset), (offset, offset), (0, 0)), mode='reflect')
+    result = np.zeros(planes.shape)
+    for i in range(planes.shape[0]):
+        for j in range(planes.shape[1]):
+            for k in range(planes.shape[2]):
+                regions = [padded[i:i+offset+1, j:j+offset+1, k], padded[i:i+offset+1, j+offset:j+kernel_size, k],
+                           padded[i+offset:i+kernel_size, j:j+offset+1, k],
+                           padded[i+offset:i+kernel_size, j+offset:j+kernel_size, k]]
+                means = [np.mean(r) for r in regions]
+                result[i, j, k] = means[np.argmin([variance(r) for r in regions])]
+    return result.reshape(image_array.shape)
+
+def _exact_variance(region):
+    # With no rounding, so equal variances tie and argmin takes the first.
+    values = [int(v) for v in region.ravel()]
+    return Fraction(len(values) * sum(v * v for v in values) - sum(values) ** 2, len(values) ** 2)
+
+def _reference_correlation(image_array, kernel, mode):
+    # The kernel times the neighbourhood it covers, anchored at
+    # ((rows - 1) // 2, (cols - 1) // 2) of the kernel, unrounded.
+    kernel_rows, kernel_cols = kernel.shape
+    top, left = (kernel_rows - 1) // 2, (kernel_cols - 1) // 2
+    planes = image_array[..., None] if image_array.ndim == 2 else image_array
+    pad_width = ((top, kernel_rows - 1 - top), (left, kernel_cols - 1 - left), (0, 0))
+    padded = np.pad(planes.astype(float), pad_width, mode=mode)
+    result = np.zeros(planes.shape)
+    for i in range(planes.shape[0]):
+        for j in range(planes.shape[1]):
+            for k in range(planes.shape[2]):
+                result[i, j, k] = np.sum(padded[i:i+kernel_rows, j:j+kernel_cols, k] * kernel)
+    return result.reshape(image_array.shape)
+
+# Weights are multiples of 1/32, so the reference sums are exact. Even,
+# non-square and separable kernels, with negative weights for clipping.
+CONVOLUTION_KERNELS = [
+    np.array([[1, 2], [3, -4]]) / 4,
+    np.arange(16).reshape(4, 4) % 5 / 8,
+    np.array([[1, 0, -1, 2, 1], [0, 3, 1, -2, 5], [1, 1, 1, 1, 1]]) / 8,
+    np.array([[1, 2], [0, 1], [-1, 3], [2, 2], [1, 0]]) / 4,
+    np.outer([1, 2, 1], [1, -1, 2, 0, 1]) / 32,
+    np.outer([1, 3, 3, 1], [1, 1]) / 16,
+]
+
+def _levels(image_array):
+    return image_array.astype(float)
+
+REFERENCES = {
+    "grayscale": (None, lambda a, v: _reference_grayscale(a)),
+    "binary": ([0, 100, 254.5], lambda a, v: np.where(_reference_grayscale(a) > v, 255, 0).astype(np.uint8)),
+    "brightness_correction": ([-300, -20, 0, 37.5, 255], lambda a, v: _uint8(_levels(a) + v)),
+    "contrast_correction": ([0.1, 0.5, 1, 1.7, 4], lambda a, v: _uint8(v * (_levels(a) - 128) + 128)),
+    "negative_filter": (None, lambda a, v: _uint8(255 - _levels(a))),
+    "binarisation": ([0, 100, 254.5], lambda a, v: np.where(_levels(a) > v, 255, 0).astype(np.uint8)),
+    "averaging": ([1, 2, 3, 4.7, 10], lambda a, v: _reference_kernel(a, _averaging_kernel(v), 'constant')),
+    "median": ([1, 2, 3, 4, 5, 10], lambda a, v: _uint8(_reference_windows(a, int(v), 'constant', np.median))),
+    "kuwahara": ([1, 2, 3, 4, 5], lambda a, v: _reference_kuwahara(a, int(v))),
+    "gaussian": ([0.1, 0.5, 1, 1.7, 3], lambda a, v: _reference_kernel(a, _gaussian_kernel(v), 'reflect')),
+    "sharpening": ([1, 5, 5.37, 20],
+                   lambda a, v: _reference_kernel(a, np.array([[0, -1, 0], [-1, v, -1], [0, -1, 0]]), 'constant')),
+    "high_pass": ([4, 10.5, 20], lambda a, v: _reference_kernel(
+        _reference_grayscale(a), np.array([[-1, -1, -1], [-1, v, -1], [-1, -1, -1]]), 'reflect')),
+    "laplace": (None, lambda a, v: _reference_kernel(
+        _reference_grayscale(a), np.array([[0, 1, 0], [1, -4, 1], [0, 1, 0]]), 'reflect')),
+    "roberts": (None, lambda a, v: _reference_roberts(a)),
+    "sobel": (None, lambda a, v: _reference_gradient(
+        a, np.array([[1, 0, -1], [2, 0, -2], [1, 0, -1]]), np.array([[1, 2, 1], [0, 0, 0], [-1, -2, -1]]), 'constant')),
+    "prewitt": (None, lambda a, v: _reference_gradient(
+        a, np.array([[-1, 0, 1]] * 3), np.array([[-1, -1, -1], [0, 0, 0], [1, 1, 1]]), 'reflect')),
+    "ridge": (None, lambda a, v: _reference_gradient(
+        a, np.array([[-1, 0, 1], [-2, 0, 2], [-1, 0, 1]]), np.array([[-1, -2, -1], [0, 0, 0], [1, 2, 1]]), 'reflect')),
+    "scharr": (None, lambda a, v: _reference_gradient(
+        a, np.array([[3, 0, -3], [10, 0, -10], [3, 0, -3]]), np.array([[3, 10, 3], [0, 0, 0], [-3, -10, -3]]),
+        'reflect')),
+}
+
+# Filters that no longer sum the 2-D kernel in the original order. Where the
+# exact value is a whole number the float sum can land on either side of it,
+# so those outputs may be one level apart; everywhere else they are equal.
+EXACT_SUMS = {
+    "averaging": lambda a, v: _reference_sums(a, _averaging_kernel(v), 'constant'),
+    "gaussian": lambda a, v: _reference_sums(a, _gaussian_kernel(v), 'reflect'),
+}
+
+def sample_images():
+    rng = np.random.default_rng(1)
+    noise = rng.integers(0, 256, (19, 23, 4), dtype=np.uint8)
+    # Smooth areas and flat runs, where ties between windows and quadrants
+    # are common.
+    y, x = np.mgrid[0:19, 0:23]
+    smooth = (np.stack([x * 11, y * 13, (x + y) * 6, 255 - x * 7], axis=2) % 256).astype(np.uint8)
+    smooth[5:12, 4:15] = 200
+    images = []
+    for array in (noise, smooth):
+        images += [Image.fromarray(array[..., 0]), Image.fromarray(array[..., :3]), Image.fromarray(array, "RGBA")]
+    # Bilevel and 16-bit images, which the filters take as 8-bit levels.
+    images.append(Image.fromarray(noise[..., 0] > 127))
+    images.append(Image.fromarray(noise[..., 1].astype(np.uint16) * 3))
+    return images
+
+def reference_levels(image):
+    # The 8-bit levels an image stands for: 0 and 255 for bilevel images,
+    # wider values clipped.
+    image_array = np.array(image)
+    if image_array.dtype == np.bool_:
+        return np.where(image_array, 255, 0).astype(np.uint8)
+    return np.clip(image_array, 0, 255).astype(np.uint8)
+
+class FilterEquivalenceTest(unittest.TestCase):
+    def check(self, name, compact=False):
+        values, reference = REFERENCES[name]
+        function = getattr(filters, name)
+        for image in sample_images():
+            image_array = reference_levels(image)
+            for value in values or [0]:
+                with self.subTest(name=name, mode=image.mode, value=value):
+                    expected = reference(image_array, value)
+                    ties = None
+                    if name in EXACT_SUMS:
+                        sums = EXACT_SUMS[name](image_array, value)
+                        ties = np.abs(sums - np.round(sums)) < 1e-9
+                    result = np.asarray(function(image, value))
+                    out = np.full(expected.shape, 7, dtype=np.uint8)
+                    returned = np.asarray(function(image, value, out=out))
+                    for actual in (result, returned, out):
+                        self.assertEqual(actual.dtype, np.uint8)
+                        difference = np.abs(actual.astype(int) - expected)
+                        if compact:
+                            # float32 sums may be a level off anywhere.
+                            self.assertLessEqual(difference.max(), 1)
+                        elif ties is not None:
+                            self.assertLessEqual(difference.max(), 1)
+                            self.assertTrue(ties[difference > 0].all())
+                        else:
+                            np.testing.assert_array_equal(actual, expected)
+
+    def test_array_levels(self):
+        # Arrays of other types are taken the same way as images.
+        for image in sample_images()[-2:]:
+            with self.subTest(mode=image.mode):
+                expected = filters.negative_filter(reference_levels(image), 0)
+                np.testing.assert_array_equal(filters.negative_filter(np.array(image), 0), expected)
+
+    def test_recursive_gaussian(self):
+        # An approximation of the Gaussian kernel, rounded instead of
+        # truncated: within one level of the original everywhere.
+        for image in sample_images():
+            image_array = reference_levels(image)
+            for sigma in (0.3, 0.5, 1.7, 4):
+                with self.subTest(mode=image.mode, sigma=sigma):
+                    expected = REFERENCES["gaussian"][1](image_array, sigma)
+                    out = np.zeros_like(expected)
+                    result = np.asarray(filters.recursive_gaussian(image, sigma, out=out))
+                    np.testing.assert_array_equal(result, out)
+                    self.assertLessEqual(np.abs(out.astype(int) - expected).max(), 1)
+
+    def test_kuwahara_ties(self):
+        # With a few levels, quadrants with different means often share the
+        # smallest variance. The filter compares variances exactly and takes
+        # the first such quadrant; the original's np.var took whichever its
+        # rounding favoured, so the two differ at those samples only.
+        rng = np.random.default_rng(2)
+        levels = (rng.integers(0, 3, (30, 34, 3)) * 127).astype(np.uint8)
+        for image_array in (levels[..., 0], levels):
+            for kernel_size in (4, 5, 6):
+                with self.subTest(channels=image_array.ndim, kernel_size=kernel_size):
+                    result = filters.kuwahara(image_array, kernel_size)
+                    np.testing.assert_array_equal(result, _reference_kuwahara(image_array, kernel_size, _exact_variance))
+                    original = _reference_kuwahara(image_array, kernel_size)
+                    self.assertLess(np.count_nonzero(result != original), result.size // 20)
+
+    def test_convolution_engines(self):
+        # Every engine against a brute-force correlation, in both padding
+        # modes. Engines round their float sums to the nearest level, so they
+        # may be a level apart only where the exact sum is half a level. The
+        # larger image spans several FFT blocks.
+        rng = np.random.default_rng(5)
+        images = sample_images() + [Image.fromarray(rng.integers(0, 256, (70, 131), dtype=np.uint8))]
+        for image in images:
+            image_array = reference_levels(image)
+            for kernel in CONVOLUTION_KERNELS:
+                engines = ["direct", "fft"] + (["separable"] if convolution.separate(kernel) is not None else [])
+                for mode in convolution.MODES:
+                    sums = _reference_correlation(image_array, kernel, mode)
+                    expected = _uint8(np.rint(sums))
+                    ties = sums - np.floor(sums) == 0.5
+                    for engine in engines:
+                        with self.subTest(mode=image.mode, size=image.size, kernel=kernel.shape,
+                                          padding=mode, engine=engine):
+                            result = np.asarray(convolution.convolve(image, kernel, mode, engine))
+                            difference = np.abs(result.astype(int) - expected)
+                            self.assertLessEqual(difference.max(), 1)
+                            self.assertTrue(ties[difference > 0].all())
+
+for _name in REFERENCES:
+    setattr(FilterEquivalenceTest, f"test_{_name}", lambda self, name=_name: self.check(name))
+
+class CompactModeTest(unittest.TestCase):
+    def setUp(self):
+        filters.COMPACT = True
+
+    def tearDown(self):
+        filters.COMPACT = False
+
+    def test_float_paths(self):
+        for name in ("gaussian", "sharpening", "high_pass"):
+            FilterEquivalenceTest.check(self, name, compact=True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+import numpy as np
+
+from convolution import parse_kernel
+from parallel import process_parallel
+from registry import apply_chain
+from tiling import process_tiled
+
+# Strips and tiles are read with a halo as wide as the chain's kernels, so
+# they must give exactly what the whole image gives. Recursive Gaussian is
+# the documented exception and is left out.
+CHAINS = [
+    [("Kuwahara", 4), ("Sharpening", 5.5)],
+    [("Brightness", 20), ("Kuwahara", 6), ("Median", 4)],
+    [("Convolution", (parse_kernel("1 2 1; 0 0 0; -1 -2 -1; 1/2 1/4 1/8"), "reflect")), ("Averaging", 3)],
+    [("Gaussian", 1.3), ("Convolution", (parse_kernel("1/3 1/3; 1/6 1/6"), "constant")), ("Sobel", 0)],
+    [("Contrast", 1.7), ("Convolution", (tuple(tuple((i * 7 + j * 3) % 5 / 9 for j in range(15))
+                                               for i in range(13)), "reflect"))],
+]
+
+# Small enough that the image is split into several tiles and strips.
+MEMORY_BUDGET = 2**16
+
+def sample_images():
+    rng = np.random.default_rng(3)
+    noise = rng.integers(0, 256, (83, 71, 3), dtype=np.uint8)
+    # Flat areas and few levels, where ties between windows are common.
+    levels = (rng.integers(0, 3, (83, 71, 3)) * 127).astype(np.uint8)
+    return [noise, noise[..., 1].copy(), levels, levels[..., 0].copy()]
+
+class ParallelEquivalenceTest(unittest.TestCase):
+    def check(self, run):
+        for image_array in sample_images():
+            for steps in CHAINS:
+                with self.subTest(channels=image_array.ndim, steps=[name for name, value in steps]):
+                    expected = np.asarray(apply_chain(image_array, steps))
+                    np.testing.assert_array_equal(run(image_array, steps), expected)
+
+    def test_tiled(self):
+        self.check(lambda image_array, steps: process_tiled(image_array, steps, memory_budget=MEMORY_BUDGET))
+
+    def test_threads(self):
+        self.check(lambda image_array, steps: process_parallel(image_array, steps, workers=3,
+                                                               memory_budget=MEMORY_BUDGET))
+
+    def test_processes(self):
+        self.check(lambda image_array, steps: process_parallel(image_array, steps, workers=2, processes=True,
+                                                               memory_budget=MEMORY_BUDGET))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import numpy as np
+
+from convolution import choose_engine, fft_working_bytes, separate
+from filters import ImageContext, _BAND_PIXELS
+from instrument import stage
+from registry import apply_chain
+
+# Rough upper bound on the bytes a filter allocates per input sample for its
+# padded buffers and summed-area tables, plus those of its float temporaries,
+# which only ever cover one band of filters._BAND_PIXELS pixels. Filters that
+# need more are estimated in filter_working_bytes.
+WORKING_BYTES_PER_SAMPLE = 14
+BAND_BYTES_PER_SAMPLE = 28
+# Recursive Gaussian holds float64 copies of the whole image padded by 3
+# sigma: the padded image, the first pass's result and the forward, backward
+# and summed passes of the second.
+RECURSIVE_GAUSSIAN_BYTES_PER_SAMPLE = 44
+MIN_TILE_SIZE = 32
+
+def filter_radius(name, value):
+    if name == "Convolution":
+        kernel = value[0]
+        return max(len(kernel), len(kernel[0])) // 2
+    if name in ("Averaging", "Median", "Kuwahara"):
+        return int(value) // 2
+    if name == "Gaussian":
+        return (int(6 * value) | 1) // 2
+    if name == "Recursive Gaussian":
+        # The recursive filter's response never ends. 10 sigma out it is
+        # below 1e-5 of a level, so a tile can only differ from the whole
+        # image where a value lies that close to rounding the other way.
+        return int(np.ceil(10 * value))
+    if name in ("Sharpening", "High Pass", "Laplace", "Ridge", "Roberts", "Prewitt", "Sobel", "Scharr"):
+        return 1
+    return 0
+
+def chain_radius(steps):
+    return sum(filter_radius(name, value) for name, value in steps)
+
+def filter_working_bytes(name, value, shape):
+    # Rough peak of the bytes a filter allocates on an image of this shape.
+    rows, cols = shape[:2]
+    channels = int(np.prod(shape[2:]))
+    if name == "Recursive Gaussian":
+        pad = 2 * ((int(6 * value) | 1) // 2)
+        return RECURSIVE_GAUSSIAN_BYTES_PER_SAMPLE * (rows + pad) * (cols + pad) * channels
+    if name == "Convolution":
+        # Only the FFT engine works on the whole image at once.
+        kernel = np.asarray(value[0], dtype=float)
+        if choose_engine(kernel, separate(kernel), (rows, cols)) == 'fft':
+            return fft_working_bytes(kernel.shape, shape)
+    band_rows = min(rows, max(1, _BAND_PIXELS // max(cols, 1)))
+    return (WORKING_BYTES_PER_SAMPLE * rows + BAND_BYTES_PER_SAMPLE * band_rows) * cols * channels
+
+def chain_working_bytes(steps, shape):
+    # The tile's own context keeps what the first filter builds on it for
+    # the rest of the chain; later intermediates are dropped as it goes. The
+    # tile and its result take a byte per sample each.
+    costs = [filter_working_bytes(name, value, shape) for name, value in steps or [(None, None)]]
+    return costs[0] + max(costs[1:], default=0) + 2 * int(np.prod(shape))
+
+def tile_size(memory_budget, channels, steps=()):
+    # The largest tile whose region, halo included, fits the budget.
+    halo = chain_radius(steps)
+    def fits(side):
+        region = (side + 2 * halo, side + 2 * halo, channels)
+        return chain_working_bytes(steps, region) <= memory_budget
+    low, high = MIN_TILE_SIZE, max(int(np.sqrt(memory_budget / channels)), MIN_TILE_SIZE)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def iter_tiles(shape, size):
+    rows, cols = shape[0], shape[1]
+    for top in range(0, rows, size):
+        for left in range(0, cols, size):
+            yield top, min(top + size, rows), left, min(left + size, cols)
+
+def _read_region(image, top, bottom, left, right):
+    if isinstance(image, ImageContext):
+        # A region covering the whole image keeps the context and whatever
+        # it has already computed.
+        if (top, left, bottom, right) == (0, 0) + image.shape[:2]:
+            return image
+        image = image.array
+    if isinstance(image, np.ndarray):
+        return ImageContext(image[top:bottom, left:right])
+    return image.crop((left, top, right, bottom))
+
+def process_tiled(image, steps, output=None, memory_budget=256 * 2**20, progress=None):
+    # Each tile is read together with a halo as wide as the chain's combined
+    # kernel radius. Halo pixels that lie inside the image are real data, and
+    # at the image border the filters pad exactly as they do on the whole
+    # image, so the stitched result equals whole-image processing. Recursive
+    # Gaussian is the exception, see filter_radius.
+    if isinstance(image, (np.ndarray, ImageContext)):
+        rows, cols = image.shape[:2]
+        channels = image.shape[2] if len(image.shape) == 3 else 1
+    else:
+        cols, rows = image.size
+        channels = len(image.getbands())
+
+    halo = chain_radius(steps)
+    size = tile_size(memory_budget, channels, steps)
+    tiles = list(iter_tiles((rows, cols), size))
+
+    for index, (top, bottom, left, right) in enumerate(tiles):
+        region_top, region_left = max(top - halo, 0), max(left - halo, 0)
+        with stage("read"):
+            region = _read_region(image, region_top, min(bottom + halo, rows), region_left, min(right + halo, cols))
+        result = np.asarray(apply_chain(region, steps))
+
+        if output is None or isinstance(output, str):
+            shape = (rows, cols) + result.shape[2:]
+            if output is None:
+                output = np.empty(shape, dtype=np.uint8)
+            else:
+                output = np.lib.format.open_memmap(output, mode='w+', dtype=np.uint8, shape=shape)
+
+        with stage("write"):
+            output[top:bottom, left:right] = result[top - region_top:bottom - region_top,
+                                                    left - region_left:right - region_left]
+        if progress is not None:
+            progress(index + 1, len(tiles))
+
+    if isinstance(output, np.memmap):
+        output.flush()
+    return output
@@ -0,0 +1,113 @@
+import queue
+import threading
+
+from filters import ImageContext, image_context
+from instrument import stage
+from parallel import process_parallel
+from tiling import process_tiled
+
+class Cancelled(Exception):
+    pass
+
+class TransformWorker():
+    # Runs filter chains on a background thread. Results and progress are
+    # passed back through a queue that the Tk main loop polls with
+    # root.after, so widgets are only touched from the main thread. A new
+    # submission cancels and supersedes the one in flight. With a cache, a run
+    # continues from the deepest cached prefix of its chain. With more than
+    # one worker, a run is split into strips processed on a thread pool.
+    # image may be a function returning the image, called on the background
+    # thread, so a slow decode does not block the main loop. Results are
+    # ImageContexts; their .image is the PIL image.
+    def __init__(self, root, memory_budget=64 * 2**20, poll_interval=30, cache=None, workers=1):
+        self.root = root
+        self.cache = cache
+        self.workers = workers
+        self.memory_budget = memory_budget
+        self.poll_interval = poll_interval
+        self.events = queue.Queue()
+        self.generation = 0
+        self.cancel_event = None
+        self.callbacks = None
+        self.polling = False
+
+    def submit(self, image, steps, on_result, on_progress=None, on_error=None):
+        self.cancel()
+        self.generation += 1
+        generation = self.generation
+        cancel_event = threading.Event()
+        self.cancel_event = cancel_event
+        self.callbacks = (on_result, on_progress, on_error)
+
+        def progress(done, total):
+            if cancel_event.is_set():
+                raise Cancelled()
+            self.events.put((generation, "progress", done / total))
+
+        def run():
+            try:
+                with stage("transform", steps=steps) as record:
+                    source_image = image_context(image() if callable(image) else image)
+                    count, source = 0, source_image
+                    if self.cache is not None:
+                        with stage("cache"):
+                            count, source, keys = self.cache.longest_prefix(source_image, steps)
+                    if record is not None:
+                        record["cached_steps"] = count
+                    if count < len(steps):
+                        if self.workers > 1:
+                            result = process_parallel(source, steps[count:], workers=self.workers,
+                                                      memory_budget=self.memory_budget, progress=progress)
+                        else:
+                            result = process_tiled(source, steps[count:], memory_budget=self.memory_budget,
+                                                   progress=progress)
+                        source = ImageContext(result, source_image.original_size)
+                        if self.cache is not None:
+                            self.cache.put(keys[-1], source)
+                self.events.put((generation, "result", image_context(source)))
+            except Cancelled:
+                self.events.put((generation, "cancelled", None))
+            except Exception as error:
+                self.events.put((generation, "error", error))
+
+        threading.Thread(target=run, daemon=True).start()
+        if not self.polling:
+            self.polling = True
+            self.root.after(self.poll_interval, self.poll)
+
+    def cancel(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.cancel_event = None
+
+    @property
+    def busy(self):
+        return self.cancel_event is not None
+
+    def poll(self):
+        while True:
+            try:
+                generation, kind, payload = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.generation:
+                continue
+
+            on_result, on_progress, on_error = self.callbacks
+            if kind == "progress":
+                if on_progress is not None:
+                    on_progress(payload)
+                continue
+
+            self.cancel_event = None
+            if kind == "result":
+                on_result(payload)
+            elif kind == "error" and on_error is not None:
+                on_error(payload)
+            elif kind == "cancelled" and on_progress is not None:
+                on_progress(0)
+
+        if self.busy:
+            self.root.after(self.poll_interval, self.poll)
+        else:
+            self.polling = False